@@ -13,6 +13,8 @@ from mozsvc.config import get_configurator
 from mozsvc.metrics import load_metlog_client
 
 from aitc.controller import AITCController
+from aitc.jsoncodec import get_codec, JSONRenderer
+from aitc.storage import create_missing_indexes
 
 
 def includeme(config):
@@ -30,7 +32,14 @@ def includeme(config):
     config.include("syncstorage.tweens")
     config.include("syncstorage.storage")
     # Add in the stuff we define ourselves.
+    codec = get_codec(config.registry.settings.get("aitc.json_codec"))
+    config.add_renderer("aitc.json", JSONRenderer(codec))
     config.scan("aitc.views")
+    # Make sure that listings by timestamp will be backed by an index,
+    # if we're allowed to change the database schema.
+    if config.registry.settings.get("storage.create_tables", False):
+        storage = config.registry["syncstorage:storage:default"]
+        create_missing_indexes(storage)
     # Create the "controller" object for handling requests.
     config.registry["aitc.controller"] = AITCController(config)
 
@@ -0,0 +1,94 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Caching of per-user collection data, in-process or in memcached.
+"""
+
+import threading
+
+from repoze.lru import ExpiringLRUCache
+
+
+# Marker object for values that are not in the cache.
+MISSING = object()
+
+
+class TimestampCache(object):
+    """Bounded, expiring cache of collection last-modified timestamps.
+
+    Entries are keyed by (userid, collection).  A value of None means the
+    collection was empty when it was looked up.  Since each process has
+    its own cache, a write handled by some other process will go unseen
+    until the entry expires, so the TTL bounds how stale it can get.
+    """
+
+    def __init__(self, size, ttl):
+        self._cache = ExpiringLRUCache(size, default_timeout=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, userid, collection):
+        """Get the cached timestamp for a collection, or MISSING."""
+        return self._cache.get((userid, collection), MISSING)
+
+    def set(self, userid, collection, timestamp):
+        """Record the current timestamp for a collection."""
+        self._cache.put((userid, collection), timestamp)
+
+    def advance(self, userid, collection, timestamp):
+        """Record a timestamp for a collection, unless it's older.
+
+        Concurrent requests can finish in any order, so a write or lookup
+        that finishes last may carry an older timestamp than the one
+        already cached.  Only a later timestamp replaces a cached one, and
+        None (for an empty collection) is only recorded if nothing is.
+        """
+        key = (userid, collection)
+        with self._lock:
+            current = self._cache.get(key, MISSING)
+            if current is MISSING or current is None or timestamp > current:
+                self._cache.put(key, timestamp)
+
+    def invalidate(self, userid, collection):
+        """Forget the timestamp for a collection."""
+        self._cache.invalidate((userid, collection))
+
+
+class ListingCache(object):
+    """Memcached store of fully-rendered collection listings.
+
+    Entries are keyed by user, collection, the collection's last-modified
+    timestamp and the variant of the listing (full or abbreviated).  Any
+    write to the collection changes its timestamp, so stale entries are
+    never looked up again and just age out of memcached on their own.
+
+    Errors talking to memcached are treated as cache misses, so that a
+    memcached outage can't take the service down with it.
+    """
+
+    def __init__(self, servers, ttl=0, prefix="aitc"):
+        import pylibmc
+        self._error = pylibmc.Error
+        self._client = pylibmc.Client(servers, binary=True)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, userid, collection, modified, variant):
+        return "%s:listing:%s:%s:%d:%s" % (self.prefix, userid, collection,
+                                            modified, variant)
+
+    def get(self, userid, collection, modified, variant):
+        """Get a rendered listing, or None if it's not in the cache."""
+        key = self._key(userid, collection, modified, variant)
+        try:
+            return self._client.get(key)
+        except self._error:
+            return None
+
+    def set(self, userid, collection, modified, variant, body):
+        """Store a rendered listing of the collection as at "modified"."""
+        key = self._key(userid, collection, modified, variant)
+        try:
+            self._client.set(key, body, time=self.ttl)
+        except self._error:
+            pass
@@ -0,0 +1,69 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Background compaction of the tombstones left by deleted items.
+
+Tombstones only need to be kept long enough for every device to sync and
+find out about the deletion.  Once they are older than the configured
+horizon they are purged, by a background thread that is handed each
+collection as items are deleted from it.  Collections that see no more
+deletes keep their old tombstones until the next garbage collection run.
+"""
+
+import time
+import Queue
+import threading
+import traceback
+
+from repoze.lru import ExpiringLRUCache
+
+from aitc.storage import purge_tombstones
+
+
+class TombstoneCompactor(object):
+    """Background worker purging old tombstones from collections.
+
+    Each collection is compacted at most once per "interval" seconds, no
+    matter how often it is scheduled.  If the worker falls too far behind,
+    further requests are dropped rather than queued up without limit.
+    """
+
+    def __init__(self, horizon, interval=3600, size=10000, logger=None):
+        self.horizon = horizon
+        self.logger = logger
+        self._recent = ExpiringLRUCache(size, default_timeout=interval)
+        self._queue = Queue.Queue(maxsize=size)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, storage, userid, collection):
+        """Arrange for a collection to be compacted in the background."""
+        key = (userid, collection)
+        if self._recent.get(key) is not None:
+            return
+        self._recent.put(key, True)
+        try:
+            self._queue.put_nowait((storage, userid, collection))
+        except Queue.Full:
+            self._recent.invalidate(key)
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def compact(self, storage, userid, collection):
+        """Purge the tombstones in a collection that are past the horizon."""
+        before = int((time.time() - self.horizon) * 1000)
+        return purge_tombstones(storage, userid, collection, before)
+
+    def _run(self):
+        while True:
+            storage, userid, collection = self._queue.get()
+            try:
+                self.compact(storage, userid, collection)
+            except Exception:
+                if self.logger is not None:
+                    self.logger.exception(traceback.format_exc())
@@ -0,0 +1,65 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Helpers for dealing with concurrent requests.
+
+These use the primitives from the threading module, which gevent's monkey
+patching turns into their greenlet-aware equivalents.  So they work the
+same under threaded servers and gevent workers.
+"""
+
+import sys
+import threading
+
+
+class _Call(object):
+    """A call in progress, whose result may be shared by several callers."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls with the same key into a single call.
+
+    The first caller for a key runs the function.  Any others arriving
+    with that key before it finishes wait for it and share its result,
+    or its exception.  Once the call completes the key is forgotten, so
+    later callers will run the function again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def call(self, key, func, *args, **kwds):
+        """Call func(*args, **kwds) unless a call for key is in progress.
+
+        This returns a tuple (result, shared) where "shared" is True if
+        the result came from a call made by some other caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result, True
+        try:
+            call.result = func(*args, **kwds)
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
@@ -2,28 +2,118 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import simplejson as json
+import re
+import time
+import zlib
+import base64
+import calendar
+import itertools
+
+import simplejson
 
 from pyramid.httpexceptions import (HTTPNotFound,
+                                    HTTPCreated,
+                                    HTTPNoContent,
+                                    HTTPBadRequest,
                                     HTTPForbidden,
+                                    HTTPGone,
+                                    HTTPNotModified,
+                                    HTTPPreconditionFailed,
                                     HTTPRequestEntityTooLarge,
                                     HTTPUnsupportedMediaType)
 
-from mozsvc.exceptions import ERROR_MALFORMED_JSON, ERROR_INVALID_OBJECT
+from mozsvc.exceptions import (ERROR_MALFORMED_JSON,
+                               ERROR_INVALID_OBJECT,
+                               ERROR_OVER_QUOTA)
+from mozsvc.plugin import load_from_settings
 
-from syncstorage.controller import StorageController, HTTPJsonBadRequest
+from syncstorage.controller import HTTPJsonBadRequest
+from syncstorage.storage import get_storage, NotFoundError
 
 from aitc import records
+from aitc.cache import TimestampCache, ListingCache, MISSING
+from aitc.compaction import TombstoneCompactor
+from aitc.concurrency import SingleFlight
+from aitc.jsoncodec import get_codec
+from aitc.notify import NotificationHub
+from aitc.tweens import GZIP_ETAG_SUFFIX
+from aitc.storage import (split_payload,
+                          upsert_record,
+                          upsert_records,
+                          delete_record,
+                          delete_records,
+                          is_tombstone,
+                          get_item_page,
+                          iter_item_pages,
+                          read_lock,
+                          get_collection_timestamp,
+                          get_tombstone_stats,
+                          OverQuotaError)
 
 
 MAX_ITEM_SIZE = 8 * 1024
+MAX_BATCH_ITEMS = 100
+MAX_BATCH_SIZE = 256 * 1024
+
+# Regex matching a valid item id, as used in the URL routes.
+VALID_ID_REGEX = re.compile("^[a-zA-Z0-9._-]+$")
+
+
+def get_encoded_size(data):
+    """Get the size of some data when encoded as compact JSON.
+
+    This gives the same answer whichever JSON codec is configured, and
+    doesn't count the whitespace that some of them add between items.
+    """
+    return len(simplejson.dumps(data, separators=(",", ":")))
+
+
+def render_json_list(name, items):
+    """Render a JSON object body mapping name to a list of encoded items.
+
+    The items must be strings that already contain valid JSON; they are
+    joined together verbatim rather than being decoded and re-encoded.
+    """
+    return render_json_lists([(name, items)])
+
+
+def render_json_lists(lists):
+    """Render a JSON object body mapping several names to lists of items.
+
+    This takes a list of (name, items) pairs, with the items given as for
+    render_json_list().
+    """
+    body = "{%s}" % (", ".join('"%s": [%s]' % (name, ", ".join(items))
+                              for (name, items) in lists),)
+    if isinstance(body, unicode):
+        body = body.encode("utf8")
+    return body
+
+
+def iter_json_list(name, pages):
+    """Generate the same body as render_json_list, one page at a time.
+
+    The pages must be lists of strings that already contain valid JSON.
+    Each page is joined into a single chunk of output, so only one page
+    of encoded items needs to be held in memory at any one time.
+    """
+    yield '{"%s": [' % (name,)
+    separator = ""
+    for page in pages:
+        if page:
+            chunk = separator + ", ".join(page)
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode("utf8")
+            yield chunk
+            separator = ", "
+    yield "]}"
 
 
 class AITCController(object):
     """Storage request controller for AITC.
 
-    This is a skinny wrapper around a SyncStorage controller that speaks
-    the diff between the two protocols.
+    This maps the AITC protocol onto a SyncStorage backend, storing each
+    record as a BSO in a collection named for its record type.
     """
 
     # This maps collection names to Record class objects that
@@ -35,28 +125,298 @@ class AITCController(object):
     }
 
     def __init__(self, config):
-        self.controller = StorageController(config)
         key = "storage.ignore_unknown_fields"
         self.ignore_unknown_fields = config.registry.settings.get(key, False)
+        settings = config.registry.settings
+        self.json = get_codec(settings.get("aitc.json_codec"))
+        # Limits on the size of request bodies for PUT and batch POST.
+        self.max_item_size = int(settings.get("aitc.max_item_size",
+                                              MAX_ITEM_SIZE))
+        self.max_batch_size = int(settings.get("aitc.max_batch_size",
+                                               MAX_BATCH_SIZE))
+        # Streaming of collection listings is opt-in, since it means that
+        # errors during the listing can no longer produce an error response.
+        self.stream_listings = settings.get("aitc.stream_listings", False)
+        self.stream_page_size = int(settings.get("aitc.stream_page_size", 100))
+        # The per-process timestamp cache is disabled unless given a size.
+        cache_size = int(settings.get("aitc.timestamp_cache_size", 0))
+        if cache_size > 0:
+            cache_ttl = int(settings.get("aitc.timestamp_cache_ttl", 60))
+            self.timestamp_cache = TimestampCache(cache_size, cache_ttl)
+        else:
+            self.timestamp_cache = None
+        # Rendered listings are cached in memcached, if servers are given.
+        servers = settings.get("aitc.listing_cache_servers")
+        if servers:
+            if isinstance(servers, basestring):
+                servers = servers.split()
+            cache_ttl = int(settings.get("aitc.listing_cache_ttl", 0))
+            self.listing_cache = ListingCache(servers, cache_ttl)
+        else:
+            self.listing_cache = None
+        # Concurrent identical listings share a single backend query.
+        self.listing_flights = SingleFlight()
+        # Long-polling is off unless given a maximum wait, in seconds.
+        # Changes made in other processes are only seen if there's a bus
+        # to pass them around, configured as "aitc.notify_bus.*".
+        max_wait = settings.get("aitc.long_poll_max_wait", 0)
+        self.long_poll_max_wait = int(max_wait)
+        if settings.get("aitc.notify_bus.backend"):
+            bus = load_from_settings("aitc.notify_bus", settings)
+        else:
+            bus = None
+        self.notifications = NotificationHub(bus)
+        # Deleted items leave tombstones, which are purged in the background
+        # once they're older than the horizon, in seconds.
+        horizon = int(settings.get("aitc.tombstone_horizon", 30 * 86400))
+        if horizon > 0:
+            logger = config.registry["metlog"]
+            self.compactor = TombstoneCompactor(horizon, logger=logger)
+        else:
+            self.compactor = None
+        # Optionally, listings of changes since longer ago than this many
+        # seconds are refused, since the tombstones of items deleted back
+        # then may have been purged.  It should be no longer than the
+        # tombstone horizon.  It's off by default, so that clients which
+        # don't expect a 410 response never get one.
+        self.after_horizon = int(settings.get("aitc.after_horizon", 0))
 
     def get_collection(self, request):
         """Get the list of items from a collection."""
-        kwds = {"full": "1"}
-        if "after" in request.GET:
-            kwds["newer"] = request.GET["after"]
-        try:
-            bsos = self.controller.get_collection(request, **kwds)["items"]
-        except HTTPNotFound:
-            bsos = []
-        items = (json.loads(bso["payload"]) for bso in bsos)
-        if "full" not in request.GET:
-            items = (self._abbreviate_item(request, item) for item in items)
-        return {request.matchdict["collection"]: list(items)}
+        self._get_record_class(request)
+        storage = get_storage(request)
+        userid = request.user["uid"]
+        collection = request.matchdict["collection"]
+        # Checking the collection timestamp is much cheaper than listing
+        # its items, and lets us skip the listing entirely if the client
+        # already has the latest data.
+        after = self._get_int_param(request, "after")
+        limit = self._get_int_param(request, "limit")
+        if limit is not None and limit < 1:
+            raise HTTPBadRequest("Invalid value for 'limit' parameter")
+        # Listings can be fetched a page at a time.  The token for each
+        # page holds the "after" value that the listing started with and
+        # the timestamp and id of the last item, to continue from.
+        cursor = None
+        if "token" in request.GET:
+            if limit is None:
+                raise HTTPBadRequest("The 'token' parameter needs a 'limit'")
+            after, cursor = self._decode_page_token(request.GET["token"])
+        self._check_after_horizon(after)
+        # Polls using "after" can ask to wait for something to change,
+        # rather than getting an empty listing straight away.
+        wait = self._get_int_param(request, "wait")
+        if wait and after is not None and self.long_poll_max_wait > 0:
+            wait = min(wait, self.long_poll_max_wait)
+            modified = self._wait_for_changes(request, storage, after, wait)
+        else:
+            modified = self._get_collection_timestamp(request, storage,
+                                                      userid, collection)
+        if modified is not None:
+            request.response.headers["ETag"] = '"%d"' % (modified,)
+            request.response.headers["X-Last-Modified"] = str(modified)
+        self._check_not_modified(request, modified)
+        response = request.response
+        response.content_type = "application/json"
+        if modified is None or (after is not None and after >= modified):
+            response.body = render_json_list(collection, [])
+            return response
+        if limit is not None:
+            if cursor is None:
+                bsos, more = get_item_page(storage, userid, collection,
+                                           limit, after)
+            else:
+                bsos, more = get_item_page(storage, userid, collection,
+                                           limit, *cursor)
+            if more:
+                cursor = (bsos[-1]["modified"], bsos[-1]["id"])
+                token = self._encode_page_token(after, cursor)
+                response.headers["X-Next-Token"] = token
+            items = self._render_payloads(request, bsos,
+                                          include_deleted=after is not None)
+            response.body = render_json_list(collection, items)
+            return response
+        # Complete listings can be served straight from the cache.
+        # Listings using "after" are too varied to be worth caching.
+        if after is None and self.listing_cache is not None:
+            cache = self.listing_cache
+            metlog = request.registry["metlog"]
+            variant = "full" if "full" in request.GET else "abbrev"
+            body = cache.get(userid, collection, modified, variant)
+            if body is not None:
+                metlog.incr("aitc.listing_cache.hit")
+                response.body = body
+                return response
+            metlog.incr("aitc.listing_cache.miss")
+        else:
+            cache = None
+        if self.stream_listings:
+            pages = iter_item_pages(storage, userid, collection, after,
+                                    self.stream_page_size)
+            # Fetch the first page now, so that any errors from the
+            # storage backend can still produce an error response.
+            first_page = pages.next()
+            pages = itertools.chain([first_page], pages)
+            pages = (self._render_payloads(request, bsos,
+                                           include_deleted=after is not None)
+                     for bsos in pages)
+            response.app_iter = iter_json_list(collection, pages)
+        else:
+            # Several devices of the same user often list the collection
+            # at the same time, so coalesce identical concurrent listings.
+            # The key includes the timestamp so that a listing started
+            # before a write is never shared with requests made after it.
+            key = (userid, collection, modified, after, "full" in request.GET)
+            body, shared = self.listing_flights.call(key, self._render_listing,
+                                                     request, storage, after)
+            if shared:
+                request.registry["metlog"].incr("aitc.listings.coalesced")
+            elif cache is not None:
+                # The items were read after the timestamp was, so they are
+                # at least as fresh as the cache key says they are.
+                cache.set(userid, collection, modified, variant, body)
+            response.body = body
+        return response
+
+    def _wait_for_changes(self, request, storage, after, wait):
+        """Wait up to "wait" seconds for a collection to change after "after".
+
+        Returns the collection's timestamp as soon as it's newer than
+        "after", or its unchanged timestamp once the wait is over.
+        """
+        userid = request.user["uid"]
+        collection = request.matchdict["collection"]
+        deadline = time.time() + wait
+        with self.notifications.watch(userid, collection) as changed:
+            while True:
+                modified = self._get_collection_timestamp(request, storage,
+                                                          userid, collection)
+                if modified is not None and modified > after:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                changed.wait(remaining)
+                changed.clear()
+                # The change may have come from another process, in which
+                # case our cached timestamp for it will be out of date.
+                if self.timestamp_cache is not None:
+                    self.timestamp_cache.invalidate(userid, collection)
+        return modified
+
+    def _render_listing(self, request, storage, after):
+        """Query the items in a collection and render the listing."""
+        userid = request.user["uid"]
+        collection = request.matchdict["collection"]
+        bsos = storage.get_items(userid, collection, newer=after)["items"]
+        items = self._render_payloads(request, bsos,
+                                      include_deleted=after is not None)
+        return render_json_list(collection, items)
+
+    def get_collections(self, request):
+        """Get the items from all the collections in a single listing.
+
+        Each collection can be given its own "after" value, using e.g. an
+        "apps_after" parameter for the apps.  A plain "after" applies to
+        all collections that aren't given one.  The items are all read
+        in the same storage session, so the listing is consistent.
+        """
+        storage = get_storage(request)
+        userid = request.user["uid"]
+        collections = sorted(self.RECORD_CLASSES)
+        default_after = self._get_int_param(request, "after")
+        afters = {}
+        for collection in collections:
+            after = self._get_int_param(request, collection + "_after")
+            if after is None:
+                after = default_after
+            self._check_after_horizon(after)
+            afters[collection] = after
+        response = request.response
+        lists = []
+        with read_lock(storage, userid, *collections):
+            timestamps = {}
+            for collection in collections:
+                timestamps[collection] = self._get_collection_timestamp(
+                    request, storage, userid, collection)
+            # Using the newest timestamp of any collection as "after" for
+            # all of them in the next request is safe, and means clients
+            # only need to keep the one value.
+            known = [ts for ts in timestamps.itervalues() if ts is not None]
+            if known:
+                modified = max(known)
+                response.headers["ETag"] = '"%d"' % (modified,)
+                response.headers["X-Last-Modified"] = str(modified)
+                self._check_not_modified(request, modified)
+            for collection in collections:
+                modified = timestamps[collection]
+                after = afters[collection]
+                if modified is None or (after is not None and
+                                        after >= modified):
+                    lists.append((collection, []))
+                    continue
+                bsos = storage.get_items(userid, collection,
+                                         newer=after)["items"]
+                items = self._render_payloads(request, bsos, collection,
+                                              after is not None)
+                lists.append((collection, items))
+        response.content_type = "application/json"
+        response.body = render_json_lists(lists)
+        return response
+
+    def get_info(self, request):
+        """Get the item count, timestamp and size of each collection.
+
+        This is answered from the backend's aggregate queries over each
+        user's collections, without reading any of the items.  Those
+        include the tombstones of deleted items, so the running totals
+        kept for the tombstones are taken off again.
+        """
+        storage = get_storage(request)
+        userid = request.user["uid"]
+        collections = sorted(self.RECORD_CLASSES)
+        with read_lock(storage, userid, *collections):
+            timestamps = storage.get_collection_timestamps(userid)
+            counts = storage.get_collection_counts(userid)
+            sizes = storage.get_collection_sizes(userid)
+            tombstones = get_tombstone_stats(storage, userid)
+        info = {}
+        for collection in collections:
+            stats = tombstones.get(collection, {})
+            count = counts.get(collection, 0) - stats.get("count", 0)
+            size = sizes.get(collection, 0) - stats.get("bytes", 0)
+            info[collection] = {
+                "count": max(count, 0),
+                "modified": timestamps.get(collection),
+                "bytes": max(size, 0),
+            }
+        known = [info[collection]["modified"] for collection in collections
+                 if info[collection]["modified"] is not None]
+        if known:
+            modified = max(known)
+            request.response.headers["X-Last-Modified"] = str(modified)
+        return info
 
     def get_item(self, request):
         """Get a single item by ID."""
-        bso = self.controller.get_item(request)
-        return json.loads(bso["payload"])
+        self._get_record_class(request)
+        storage = get_storage(request)
+        userid = request.user["uid"]
+        collection = request.matchdict["collection"]
+        item_id = request.matchdict["item"]
+        try:
+            bso = storage.get_item(userid, collection, item_id)
+        except NotFoundError:
+            raise HTTPNotFound()
+        if is_tombstone(bso["payload"]):
+            raise HTTPNotFound()
+        # Each item's ETag is its modification time, which changes with
+        # every write to it.
+        modified = bso["modified"]
+        request.response.headers["ETag"] = '"%d"' % (modified,)
+        request.response.headers["X-Last-Modified"] = str(modified)
+        self._check_not_modified(request, modified)
+        return self.json.loads(split_payload(bso["payload"])[0])
 
     def set_item(self, request):
         """Upload a new item by ID."""
@@ -64,10 +424,9 @@ class AITCController(object):
         if request.content_type not in ("application/json", None):
             msg = "Unsupported Media Type: %s" % (request.content_type,)
             raise HTTPUnsupportedMediaType(msg)
-        if len(request.body) > MAX_ITEM_SIZE:
-            raise HTTPRequestEntityTooLarge()
+        body = self._get_request_body(request, self.max_item_size)
         try:
-            data = json.loads(request.body)
+            data = self.json.loads(body)
         except ValueError:
             raise HTTPJsonBadRequest(ERROR_MALFORMED_JSON)
         item = self._parse_item(request, data)
@@ -77,47 +436,402 @@ class AITCController(object):
         # trigger pyramid's prompt-for-credentials handlers.
         if request.matchdict["item"] != item.get_id():
             return HTTPForbidden("Item ID does not match origin")
-        # Pass through to storage.
-        # Requires another round-trip through JSON; yuck.
-        request.body = json.dumps({"payload": json.dumps(item)})
-        return self.controller.set_item(request)
+        return self._write_item(request, item)
+
+    def set_items(self, request):
+        """Upload a batch of items, each with its own ID."""
+        self._get_record_class(request)
+        if request.content_type not in ("application/json", None):
+            msg = "Unsupported Media Type: %s" % (request.content_type,)
+            raise HTTPUnsupportedMediaType(msg)
+        body = self._get_request_body(request, self.max_batch_size)
+        try:
+            data = self.json.loads(body)
+        except ValueError:
+            raise HTTPJsonBadRequest(ERROR_MALFORMED_JSON)
+        if not isinstance(data, list):
+            raise HTTPJsonBadRequest(ERROR_INVALID_OBJECT)
+        if len(data) > MAX_BATCH_ITEMS:
+            raise HTTPRequestEntityTooLarge()
+        # Each item succeeds or fails on its own.  Those that can't be
+        # given an ID are reported by their position in the batch.
+        res = {"success": [], "failed": {}}
+        items = []
+        for i, item_data in enumerate(data):
+            item, error = self._load_item(request, item_data)
+            if error is not None:
+                res["failed"][str(i)] = [error]
+                continue
+            item_id = item.get_id()
+            if get_encoded_size(item_data) > self.max_item_size:
+                res["failed"][item_id] = ["item is too large"]
+                continue
+            items.append(item)
+            res["success"].append(item_id)
+        if items:
+            storage = get_storage(request)
+            userid = request.user["uid"]
+            collection = request.matchdict["collection"]
+            try:
+                modified = upsert_records(storage, userid, collection, items,
+                                          codec=self.json)
+            except OverQuotaError:
+                raise HTTPJsonBadRequest(ERROR_OVER_QUOTA)
+            self._set_collection_timestamp(userid, collection, modified)
+            request.response.headers["X-Last-Modified"] = str(modified)
+        return res
 
     def delete_item(self, request):
         """Delete a single item by ID."""
-        return self.controller.delete_item(request)
+        RecordClass = self._get_record_class(request)
+        storage = get_storage(request)
+        userid = request.user["uid"]
+        collection = request.matchdict["collection"]
+        item_id = request.matchdict["item"]
+
+        def precondition(old_bso):
+            self._check_write_preconditions(request, old_bso)
 
-    def _parse_item(self, request, data):
-        """Parse and validate data for a single item."""
-        # Find the correct type of Record object to create.
         try:
-            RecordClass = self.RECORD_CLASSES[request.matchdict["collection"]]
-        except KeyError:
+            modified = delete_record(storage, userid, collection, item_id,
+                                     RecordClass, request.server_time,
+                                     precondition, codec=self.json)
+        except NotFoundError:
             raise HTTPNotFound()
+        self._set_collection_timestamp(userid, collection, modified)
+        self._schedule_compaction(storage, userid, collection)
+        response = HTTPNoContent()
+        response.headers["X-Last-Modified"] = str(modified)
+        return response
+
+    def delete_collection(self, request):
+        """Delete a whole collection, or the items listed in "ids"."""
+        RecordClass = self._get_record_class(request)
+        storage = get_storage(request)
+        userid = request.user["uid"]
+        collection = request.matchdict["collection"]
+        if "ids" in request.GET:
+            ids = request.GET["ids"].split(",")
+            if len(ids) > MAX_BATCH_ITEMS:
+                raise HTTPBadRequest("Too many ids")
+            for item_id in ids:
+                if not VALID_ID_REGEX.match(item_id):
+                    raise HTTPBadRequest("Invalid id: %r" % (item_id,))
+        else:
+            ids = None
+        # Deleting things that don't exist is not an error, and leaves the
+        # collection's timestamp as it was.
+        modified = delete_records(storage, userid, collection, RecordClass,
+                                  request.server_time, ids, codec=self.json)
+        if modified is not None:
+            self._set_collection_timestamp(userid, collection, modified)
+            self._schedule_compaction(storage, userid, collection)
+        else:
+            modified = self._get_collection_timestamp(request, storage,
+                                                      userid, collection)
+        response = HTTPNoContent()
+        if modified is not None:
+            response.headers["X-Last-Modified"] = str(modified)
+        return response
+
+    def delete_storage(self, request):
+        """Delete all stored data for the user."""
+        storage = get_storage(request)
+        userid = request.user["uid"]
+        try:
+            storage.delete_storage(userid)
+        finally:
+            for collection in self.RECORD_CLASSES:
+                self._set_collection_timestamp(userid, collection, None)
+        return HTTPNoContent()
+
+    def _get_request_body(self, request, max_size):
+        """Get the request body, enforcing a limit on its decoded size.
+
+        Oversized bodies are rejected based on their Content-Length before
+        any of the body is read, and the read itself stops once the limit
+        is passed, so large uploads can't tie up the worker's memory.
+
+        Bodies sent with "Content-Encoding: gzip" are decompressed, and
+        the limit applies to the decompressed size.  Decompression stops
+        as soon as the limit is passed, so a small body can't be used to
+        make us inflate a huge one.
+        """
+        content_length = request.content_length
+        if content_length is not None and content_length > max_size:
+            raise HTTPRequestEntityTooLarge()
+        body = request.body_file.read(max_size + 1)
+        if len(body) > max_size:
+            raise HTTPRequestEntityTooLarge()
+        encoding = request.headers.get("Content-Encoding", "identity")
+        encoding = encoding.strip().lower()
+        if encoding == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                body = decompressor.decompress(body, max_size + 1)
+                if len(body) <= max_size:
+                    body += decompressor.flush()
+            except zlib.error:
+                raise HTTPBadRequest("Invalid gzip request body")
+            if len(body) > max_size:
+                raise HTTPRequestEntityTooLarge()
+        elif encoding != "identity":
+            msg = "Unsupported Content-Encoding: %s" % (encoding,)
+            raise HTTPUnsupportedMediaType(msg)
+        return body
+
+    def _parse_item(self, request, data):
+        """Parse and validate data for a single item."""
+        item, error = self._load_item(request, data)
+        if error is not None:
+            raise HTTPJsonBadRequest(ERROR_INVALID_OBJECT)
+        return item
+
+    def _load_item(self, request, data):
+        """Load and validate data for a single item.
+
+        This returns a tuple (item, error) where exactly one of the two
+        is not None, so that callers can decide how to report errors.
+        """
+        RecordClass = self._get_record_class(request)
         # Load the data into an object of that type.
         try:
             kwds = {"ignore_unknown_fields": self.ignore_unknown_fields}
             item = RecordClass(data, **kwds)
-        except ValueError:
-            raise HTTPJsonBadRequest(ERROR_INVALID_OBJECT)
-        # Get any existing values for that item.
-        try:
-            old_bso = self.controller.get_item(request)
-            old_item = json.loads(old_bso["payload"])
-        except HTTPNotFound:
-            old_item = None
+        except ValueError, e:
+            return None, str(e)
         # Fill in missing values and validate.
-        item.populate(request, old_item)
+        # The creation timestamp is set as if this were a new item, and
+        # will be replaced by the existing value (if any) at write time.
+        item.populate(request)
         ok, error = item.validate()
         if not ok:
-            raise HTTPJsonBadRequest(ERROR_INVALID_OBJECT)
-        return item
+            return None, error
+        return item, None
 
-    def _abbreviate_item(self, request, data):
-        """Produce abbreviated data for a single item."""
+    def _get_record_class(self, request, collection=None):
+        """Find the correct type of Record object for the collection."""
+        if collection is None:
+            collection = request.matchdict["collection"]
         try:
-            RecordClass = self.RECORD_CLASSES[request.matchdict["collection"]]
-        except KeyError:  # pragma nocover
+            return self.RECORD_CLASSES[collection]
+        except KeyError:
             raise HTTPNotFound()
+
+    def _render_payloads(self, request, bsos, collection=None,
+                         include_deleted=False):
+        """Get the list of JSON strings to output for some stored items.
+
+        The tombstones of deleted items are left out unless asked for.
+        Clients only need them when fetching changes using "after".
+        """
+        # The stored payloads are already JSON-encoded items, so we
+        # can splice them straight into the output without decoding.
+        payloads = [split_payload(bso["payload"]) for bso in bsos
+                    if include_deleted or not is_tombstone(bso["payload"])]
+        if "full" in request.GET:
+            return [full for (full, abbrev) in payloads]
+        return [self._abbreviate_payload(request, full, abbrev, collection)
+                for (full, abbrev) in payloads]
+
+    def _get_collection_timestamp(self, request, storage, userid, collection):
+        """Get the last-modified time of a collection, or None if empty.
+
+        This is served from the per-process timestamp cache if enabled,
+        with hits and misses counted in metlog.
+        """
+        if self.timestamp_cache is None:
+            return get_collection_timestamp(storage, userid, collection)
+        metlog = request.registry["metlog"]
+        modified = self.timestamp_cache.get(userid, collection)
+        if modified is not MISSING:
+            metlog.incr("aitc.timestamp_cache.hit")
+            return modified
+        metlog.incr("aitc.timestamp_cache.miss")
+        modified = get_collection_timestamp(storage, userid, collection)
+        self.timestamp_cache.advance(userid, collection, modified)
+        return modified
+
+    def _set_collection_timestamp(self, userid, collection, modified):
+        """Update the timestamp cache after a write to a collection.
+
+        A timestamp of None means that the new value is not known, and
+        it will be looked up again on next use.  The cached value only
+        ever moves forward, so a write that finishes after a later one
+        can't roll it back.  This also wakes up any long-polls waiting for
+        the collection to change.
+        """
+        if self.timestamp_cache is not None:
+            if modified is None:
+                self.timestamp_cache.invalidate(userid, collection)
+            else:
+                self.timestamp_cache.advance(userid, collection, modified)
+        self.notifications.notify(userid, collection)
+
+    def _schedule_compaction(self, storage, userid, collection):
+        """Arrange for old tombstones to be purged from a collection."""
+        if self.compactor is not None:
+            self.compactor.schedule(storage, userid, collection)
+
+    def _get_int_param(self, request, name):
+        """Get an optional integer parameter from the query string."""
+        value = request.GET.get(name)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise HTTPBadRequest("Invalid value for %r parameter" % (name,))
+
+    def _check_after_horizon(self, after):
+        """Refuse to list changes since before the "after" horizon.
+
+        Tombstones older than the horizon may already have been purged, so
+        a listing of the changes since then could silently miss deletes.
+        Clients get a 410 Gone instead, telling them to fetch a complete
+        listing.  An "after" of zero or less asks for everything, so it
+        is never refused.
+        """
+        if after is None or after <= 0 or self.after_horizon <= 0:
+            return
+        horizon = int((time.time() - self.after_horizon) * 1000)
+        if after < horizon:
+            msg = "Changes since %d are no longer available" % (after,)
+            raise HTTPGone(msg)
+
+    def _encode_page_token(self, after, cursor):
+        """Encode an opaque token for continuing a paginated listing.
+
+        The cursor is the (modified, id) of the last item already listed.
+        """
+        modified, item_id = cursor
+        token = self.json.dumps([after, modified, item_id])
+        return base64.urlsafe_b64encode(token).rstrip("=")
+
+    def _decode_page_token(self, token):
+        """Decode a listing token into its "after" value and cursor."""
+        try:
+            token = token.encode("ascii")
+            token += "=" * (-len(token) % 4)
+            data = self.json.loads(base64.urlsafe_b64decode(token))
+            after, modified, item_id = data
+        except (ValueError, TypeError):
+            raise HTTPBadRequest("Invalid value for 'token' parameter")
+        if after is not None and not isinstance(after, (int, long)):
+            raise HTTPBadRequest("Invalid value for 'token' parameter")
+        if not isinstance(modified, (int, long)):
+            raise HTTPBadRequest("Invalid value for 'token' parameter")
+        if not isinstance(item_id, basestring):
+            raise HTTPBadRequest("Invalid value for 'token' parameter")
+        if not VALID_ID_REGEX.match(item_id):
+            raise HTTPBadRequest("Invalid value for 'token' parameter")
+        return after, (modified, item_id)
+
+    def _etag_matches(self, modified, etags):
+        """Check whether the ETag for a modification time is in a list.
+
+        Either form of the ETag matches, the plain one or the one given to
+        compressed responses.
+        """
+        etag = str(modified)
+        return etag in etags or etag + GZIP_ETAG_SUFFIX in etags
+
+    def _check_not_modified(self, request, modified):
+        """Raise 304 Not Modified if the client has the latest data.
+
+        This honours If-None-Match against the ETag derived from the
+        modification time, and falls back to If-Modified-Since or our own
+        X-If-Modified-Since if no ETags were given.
+        """
+        if modified is None:
+            return
+        # WebOb parses "If-None-Match: *" into an ETag matcher that is
+        # false in a boolean context, so check for the header itself.
+        if "If-None-Match" in request.headers:
+            not_modified = self._etag_matches(modified, request.if_none_match)
+        elif "X-If-Modified-Since" in request.headers:
+            try:
+                ts = int(request.headers["X-If-Modified-Since"])
+            except ValueError:
+                raise HTTPBadRequest("Invalid X-If-Modified-Since header")
+            not_modified = modified <= ts
+        elif request.if_modified_since is not None:
+            ts = calendar.timegm(request.if_modified_since.utctimetuple())
+            not_modified = modified // 1000 <= ts
+        else:
+            not_modified = False
+        if not_modified:
+            raise HTTPNotModified(headers={
+                "ETag": '"%d"' % (modified,),
+                "X-Last-Modified": str(modified),
+            })
+
+    def _write_item(self, request, item):
+        """Write a validated record directly into the storage backend.
+
+        This skips the SyncStorage controller, which would otherwise need
+        the record re-encoded into a BSO request body only to parse it
+        straight back out again.
+        """
+        storage = get_storage(request)
+        userid = request.user["uid"]
+        collection = request.matchdict["collection"]
+        item_id = request.matchdict["item"]
+
+        def precondition(old_bso):
+            self._check_write_preconditions(request, old_bso)
+
+        try:
+            res = upsert_record(storage, userid, collection, item_id, item,
+                                precondition, codec=self.json)
+        except OverQuotaError:
+            raise HTTPJsonBadRequest(ERROR_OVER_QUOTA)
+        if res.get("unchanged"):
+            # The collection may have changed since this item did, so its
+            # timestamp can't be used to update the cache.
+            request.registry["metlog"].incr("aitc.writes.unchanged")
+        else:
+            self._set_collection_timestamp(userid, collection,
+                                           res["modified"])
+        if res["created"]:
+            response = HTTPCreated()
+        else:
+            response = HTTPNoContent()
+        response.headers["ETag"] = '"%d"' % (res["modified"],)
+        response.headers["X-Last-Modified"] = str(res["modified"])
+        return response
+
+    def _check_write_preconditions(self, request, old_bso):
+        """Enforce any conditional headers on a write to an item.
+
+        This is given the currently-stored BSO, or None if there isn't one,
+        and is called under the write lock so that it can't change before
+        the write goes through.
+        """
+        if "If-Match" in request.headers:
+            # This covers "If-Match: *", which needs an existing item.
+            if old_bso is None:
+                raise HTTPPreconditionFailed()
+            if not self._etag_matches(old_bso["modified"], request.if_match):
+                raise HTTPPreconditionFailed()
+        if "X-If-Unmodified-Since" in request.headers:
+            try:
+                ts = int(request.headers["X-If-Unmodified-Since"])
+            except ValueError:
+                raise HTTPBadRequest("Invalid X-If-Unmodified-Since header")
+            if old_bso is not None and old_bso["modified"] > ts:
+                raise HTTPPreconditionFailed()
+
+    def _abbreviate_payload(self, request, full, abbrev, collection=None):
+        """Produce abbreviated JSON for a single stored item."""
+        if abbrev is not None:
+            return abbrev
+        # Items written before we started storing the abbreviated form
+        # must be decoded and abbreviated on the fly, until they are next
+        # written or are rewritten by "aitc-purge --backfill".
+        request.registry["metlog"].incr("aitc.listings.legacy_payloads")
+        RecordClass = self._get_record_class(request, collection)
+        data = self.json.loads(full)
         # Don't error out if the database contains items with unknown fields.
         item = RecordClass(data, ignore_unknown_fields=True)
-        return item.abbreviate()
+        return self.json.dumps(item.abbreviate())
@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Pluggable JSON encoding and decoding.
+
+Decoding request bodies and encoding records is a large part of the
+CPU time spent on each request, so the JSON library is configurable via
+the "aitc.json_codec" setting.  The default is simplejson.  A value of
+"auto" picks the fastest lossless library that is installed: simplejson
+if it has its C speedups, otherwise the standard library's json module.
+
+ujson is faster still, but only used if asked for by name.  It encodes
+floats with limited precision, so floats in client data (such as the
+"apps" of a device) would not be stored exactly as they were sent.
+
+Content hashes of records always use simplejson, since they must come
+out the same no matter which codec the server is configured with.
+"""
+
+import simplejson
+
+
+class JSONCodec(object):
+    """A named pair of JSON loads() and dumps() functions.
+
+    Both must work like their simplejson counterparts for the plain
+    JSON-compatible data handled by AITC; in particular loads() must
+    raise ValueError for invalid input.  A codec is lossless if decoding
+    what it encodes always gives back exactly the same data.
+    """
+
+    def __init__(self, name, loads, dumps, lossless=True):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+        self.lossless = lossless
+
+    def __repr__(self):
+        return "<JSONCodec %s>" % (self.name,)
+
+
+def _load_ujson():
+    import ujson
+    return JSONCodec("ujson", ujson.loads, ujson.dumps, lossless=False)
+
+
+def _load_simplejson():
+    return JSONCodec("simplejson", simplejson.loads, simplejson.dumps)
+
+
+def _load_json():
+    import json
+    return JSONCodec("json", json.loads, json.dumps)
+
+
+CODECS = {
+    "ujson": _load_ujson,
+    "simplejson": _load_simplejson,
+    "json": _load_json,
+}
+
+
+def has_simplejson_speedups():
+    """Check whether simplejson is using its C extension module."""
+    try:
+        from simplejson import _speedups
+    except ImportError:
+        return False
+    return _speedups is not None
+
+
+def get_codec(name=None):
+    """Get the JSON codec with the given name, or the default one.
+
+    Asking for a codec by name will raise ImportError if its library is
+    not installed.  Asking for "auto", or for None, never fails.
+    """
+    if name is None:
+        return _load_simplejson()
+    if name == "auto":
+        if has_simplejson_speedups():
+            return _load_simplejson()
+        try:
+            return _load_json()
+        except ImportError:
+            return _load_simplejson()
+    try:
+        loader = CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown JSON codec: %r" % (name,))
+    return loader()
+
+
+def get_available_codecs():
+    """Get a list of all the codecs whose libraries are installed."""
+    codecs = []
+    for name in sorted(CODECS):
+        try:
+            codecs.append(CODECS[name]())
+        except ImportError:
+            pass
+    return codecs
+
+
+class JSONRenderer(object):
+    """Pyramid renderer factory that encodes view results with a codec."""
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def __call__(self, info):
+        def render(value, system):
+            request = system.get("request")
+            if request is not None:
+                response = request.response
+                if response.content_type == response.default_content_type:
+                    response.content_type = "application/json"
+            return self.codec.dumps(value)
+        return render
@@ -0,0 +1,105 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Notification of changes to collections, for long-polling requests.
+
+Requests waiting for a collection to change register with the process's
+NotificationHub, and writes to the collection wake them up.  Writes made
+by other processes can only be seen if the hub is given a bus, which
+broadcasts each notification to the hubs in all the other processes.
+
+Like the helpers in aitc.concurrency, this uses the threading module's
+primitives, which gevent's monkey-patching makes greenlet-aware.  Parking
+a request is cheap under a gevent worker, but ties up a whole thread
+under a threaded server, so long-polling is off by default.
+"""
+
+import threading
+import contextlib
+
+
+class NotificationHub(object):
+    """In-process registry of requests waiting on changes to collections.
+
+    If given a bus, every notification is also published on it, and those
+    received from the bus are passed on to the local waiters.  A bus needs
+    publish(userid, collection) and subscribe(callback) methods.
+    """
+
+    def __init__(self, bus=None):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self.bus = bus
+        if bus is not None:
+            bus.subscribe(self.notify_local)
+
+    @contextlib.contextmanager
+    def watch(self, userid, collection):
+        """Context manager giving an Event that is set on each change.
+
+        Start watching before checking whether the collection has already
+        changed, so that no change can slip by between the check and the
+        wait.  The event must be cleared by the waiter after each wakeup.
+        """
+        key = (str(userid), collection)
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(key, set()).add(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                waiters = self._waiters[key]
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[key]
+
+    def notify(self, userid, collection):
+        """Notify everyone watching a collection that it has changed."""
+        self.notify_local(userid, collection)
+        if self.bus is not None:
+            self.bus.publish(userid, collection)
+
+    def notify_local(self, userid, collection):
+        """Notify watchers in this process only."""
+        key = (str(userid), collection)
+        with self._lock:
+            events = list(self._waiters.get(key, ()))
+        for event in events:
+            event.set()
+
+
+class ZeroMQBus(object):
+    """Bus broadcasting change notifications between processes over 0MQ.
+
+    Each process publishes its notifications to, and subscribes to those
+    of all processes from, a shared 0MQ forwarder device listening on the
+    two given endpoints.  This needs gevent and gevent_zeromq.
+    """
+
+    def __init__(self, publish_endpoint, subscribe_endpoint):
+        from gevent_zeromq import zmq
+        self._zmq = zmq
+        self._context = zmq.Context()
+        self._publisher = self._context.socket(zmq.PUB)
+        self._publisher.connect(publish_endpoint)
+        self.subscribe_endpoint = subscribe_endpoint
+
+    def publish(self, userid, collection):
+        self._publisher.send("%s %s" % (userid, collection))
+
+    def subscribe(self, callback):
+        import gevent
+        subscriber = self._context.socket(self._zmq.SUB)
+        subscriber.setsockopt(self._zmq.SUBSCRIBE, "")
+        subscriber.connect(self.subscribe_endpoint)
+        gevent.spawn(self._receive, subscriber, callback)
+
+    def _receive(self, subscriber, callback):
+        while True:
+            try:
+                userid, collection = subscriber.recv().split(" ", 1)
+            except ValueError:
+                continue
+            callback(userid, collection)
@@ -0,0 +1,243 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Garbage collection of stale AITC data.
+
+This walks through the users with data in a range of userids, purging the
+tombstones of items that were deleted longer ago than the tombstone horizon,
+and optionally deleting all the AITC data of users who haven't written any
+for a long time.  With --backfill, it also rewrites items stored before the
+abbreviated form of each record was stored alongside it, so that listings no
+longer have to abbreviate them on the fly.  It works in small batches at a
+limited rate, so that it can run against a live database, and can keep a
+checkpoint file so that it can be stopped and resumed.  Run it like so:
+
+    aitc-purge --end-userid=1000000 --checkpoint=purge.txt production.ini
+
+The storage backend is loaded from the [storage] section of the config
+file, and the default tombstone horizon from its [aitc] section.
+
+"""
+
+import os
+import sys
+import time
+import errno
+import logging
+import optparse
+
+from mozsvc.config import get_configurator
+
+from aitc.controller import AITCController
+from aitc.storage import (purge_tombstones,
+                          purge_items,
+                          backfill_payloads,
+                          iter_userids)
+
+
+logger = logging.getLogger("aitc.purge")
+
+
+class RateLimiter(object):
+    """Limit the rate of some operation to a number per second.
+
+    Call wait() before each operation; it sleeps as long as needed to keep
+    to the rate.  A rate of zero means there is no limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next_time = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.time()
+        if now < self._next_time:
+            time.sleep(self._next_time - now)
+            now = self._next_time
+        self._next_time = now + self.interval
+
+
+def read_checkpoint(path):
+    """Read the last userid that was completed, or None if there isn't one."""
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def write_checkpoint(path, userid):
+    """Record the last userid that was completed.
+
+    The file is replaced atomically, so that stopping the process at any
+    point leaves either the old checkpoint or the new one.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("%d\n" % (userid,))
+    os.rename(tmp_path, path)
+
+
+def purge_user(storage, userid, collections, tombstones_before,
+               inactive_before=None, batch_size=100, limiter=None):
+    """Purge the stale data of a single user.
+
+    If none of the given collections were modified since inactive_before
+    then all their items are deleted, leaving the user's other collections
+    alone.  Otherwise tombstones older than tombstones_before are purged.
+    Either way, items are deleted in batches of at most batch_size, and
+    the limiter is waited on before each storage operation.
+
+    Returns a tuple (number of tombstones purged, whether all the user's
+    data was deleted).
+    """
+    if limiter is None:
+        limiter = RateLimiter(0)
+    limiter.wait()
+    timestamps = storage.get_collection_timestamps(userid)
+    timestamps = dict((collection, ts)
+                      for (collection, ts) in timestamps.iteritems()
+                      if collection in collections and ts is not None)
+    if not timestamps:
+        return 0, False
+    if inactive_before is not None:
+        if max(timestamps.itervalues()) < inactive_before:
+            for collection in sorted(timestamps):
+                purge_items(storage, userid, collection, inactive_before,
+                            batch_size, limiter.wait)
+            return 0, True
+    num_purged = 0
+    for collection in sorted(timestamps):
+        num_purged += purge_tombstones(storage, userid, collection,
+                                       tombstones_before, batch_size,
+                                       limiter.wait)
+    return num_purged, False
+
+
+def backfill_user(storage, userid, record_classes, batch_size=100,
+                  limiter=None):
+    """Rewrite a single user's legacy payloads in the current format.
+
+    This takes a dict mapping collection names to their record classes.
+    Returns the number of items rewritten.
+    """
+    if limiter is None:
+        limiter = RateLimiter(0)
+    num_rewritten = 0
+    for collection in sorted(record_classes):
+        num_rewritten += backfill_payloads(storage, userid, collection,
+                                           record_classes[collection],
+                                           batch_size=batch_size,
+                                           throttle=limiter.wait)
+    return num_rewritten
+
+
+def main(args=None):
+    """Command-line entry point for purging stale data."""
+    usage = "usage: %prog [options] config_file"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--start-userid", type="int", default=1,
+                      help="first userid to process")
+    parser.add_option("--end-userid", type="int",
+                      help="last userid to process")
+    parser.add_option("--horizon", type="int",
+                      help="purge tombstones older than this many seconds; "
+                           "defaults to the aitc.tombstone_horizon setting")
+    parser.add_option("--inactive-days", type="int",
+                      help="delete all AITC data of users with no writes "
+                           "for this many days")
+    parser.add_option("--batch-size", type="int", default=100,
+                      help="maximum number of items deleted at once")
+    parser.add_option("--rate", type="float", default=10,
+                      help="maximum storage operations per second, "
+                           "or zero for no limit")
+    parser.add_option("--backfill", action="store_true",
+                      help="also rewrite items stored in the old format")
+    parser.add_option("--checkpoint",
+                      help="file for recording progress, to resume from")
+    parser.add_option("--checkpoint-interval", type="int", default=100,
+                      help="number of users between checkpoints")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="log each user that is purged")
+
+    if args is None:
+        args = sys.argv[1:]
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("you must specify a config file")
+    if opts.end_userid is None:
+        parser.error("you must specify --end-userid")
+    if opts.batch_size < 1:
+        parser.error("--batch-size must be positive")
+
+    level = logging.DEBUG if opts.verbose else logging.INFO
+    logging.basicConfig(level=level, format="%(asctime)s %(message)s")
+
+    config_file = os.path.abspath(args[0])
+    config = get_configurator({"__file__": config_file})
+    config.include("syncstorage.storage")
+    storage = config.registry["syncstorage:storage:default"]
+    settings = config.registry.settings
+
+    horizon = opts.horizon
+    if horizon is None:
+        horizon = int(settings.get("aitc.tombstone_horizon", 30 * 86400))
+    now = time.time()
+    tombstones_before = int((now - horizon) * 1000)
+    inactive_before = None
+    if opts.inactive_days is not None:
+        inactive_before = int((now - opts.inactive_days * 86400) * 1000)
+    collections = set(AITCController.RECORD_CLASSES)
+    limiter = RateLimiter(opts.rate)
+
+    start_userid = opts.start_userid
+    if opts.checkpoint is not None:
+        last_userid = read_checkpoint(opts.checkpoint)
+        if last_userid is not None:
+            start_userid = max(start_userid, last_userid + 1)
+            logger.info("resuming after userid %d", last_userid)
+
+    total_purged = total_deleted = total_rewritten = 0
+    # Only users that have some data are visited, found a batch at a time.
+    userids = iter_userids(storage, start_userid, opts.end_userid,
+                           throttle=limiter.wait)
+    for num_users, userid in enumerate(userids):
+        num_purged, deleted = purge_user(storage, userid, collections,
+                                         tombstones_before, inactive_before,
+                                         opts.batch_size, limiter)
+        total_purged += num_purged
+        if deleted:
+            total_deleted += 1
+            logger.debug("deleted all data for user %d", userid)
+        elif num_purged:
+            logger.debug("purged %d tombstones for user %d",
+                         num_purged, userid)
+        if opts.backfill and not deleted:
+            num_rewritten = backfill_user(storage, userid,
+                                          AITCController.RECORD_CLASSES,
+                                          opts.batch_size, limiter)
+            total_rewritten += num_rewritten
+            if num_rewritten:
+                logger.debug("rewrote %d items for user %d",
+                             num_rewritten, userid)
+        if opts.checkpoint is not None:
+            if (num_users + 1) % opts.checkpoint_interval == 0:
+                write_checkpoint(opts.checkpoint, userid)
+                logger.info("reached userid %d: %d tombstones purged, "
+                            "%d users deleted, %d items rewritten", userid,
+                            total_purged, total_deleted, total_rewritten)
+    if opts.checkpoint is not None:
+        write_checkpoint(opts.checkpoint, opts.end_userid)
+    logger.info("finished: %d tombstones purged, %d users deleted, "
+                "%d items rewritten", total_purged, total_deleted,
+                total_rewritten)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,8 @@ import re
 import hashlib
 import base64
 
+import simplejson as json
+
 # Regex matching a UUID in uppercase 8-4-4-4-12 hexadecimal format.
 VALID_UUID_REGEX = re.compile("^[A-Z0-9]{8}-[A-Z0-9]{4}-[A-Z0-9]{4}-"\
                               "[A-Z0-9]{4}-[A-Z0-9]{12}$")
@@ -19,15 +21,185 @@ def origin_to_id(value):
     return base64.urlsafe_b64encode(digest).rstrip("=")
 
 
-class Record(dict):
-    """Base class for dealing with different types of record."""
+class Field(object):
+    """Declaration of a single field in a record schema.
+
+    Each record class declares its fields once, in a SCHEMA tuple.  The
+    RecordType metaclass compiles the declarations into a specialized
+    validate() method when the class is created, so validating a record
+    runs straight-line code with no per-field lookups or loops.
+
+    Subclasses provide the source code for checking a field's value.
+    """
+
+    def __init__(self, name, required=True):
+        self.name = name
+        self.required = required
+
+    def get_source(self, namespace):
+        """Get lines of source code validating this field of "self".
+
+        Any objects referenced by the code must be added to the given
+        namespace dict, under names that won't clash with other fields.
+        """
+        if self.required:
+            lines = [
+                "try:",
+                "    value = self.%s" % (self.name,),
+                "except AttributeError:",
+                "    return False, %r" % ("missing field %r" % (self.name,),),
+            ]
+            lines.extend(self.get_check_source(namespace))
+        else:
+            lines = [
+                "value = getattr(self, %r, None)" % (self.name,),
+                "if value is not None:",
+            ]
+            check_lines = self.get_check_source(namespace)
+            lines.extend("    " + ln for ln in check_lines)
+        return lines
+
+    def get_check_source(self, namespace):
+        """Get lines of source code validating a field value in "value"."""
+        raise NotImplementedError  # pragma: nocover
+
+    def fail(self, description):
+        """Get a line of source code reporting an invalid value."""
+        return "    return False, %r" % ("%s %s" % (self.name, description),)
+
+
+class StringField(Field):
+    """A field whose value must be a string, optionally non-empty."""
+
+    def __init__(self, name, nonempty=False, **kwds):
+        super(StringField, self).__init__(name, **kwds)
+        self.nonempty = nonempty
+
+    def get_check_source(self, namespace):
+        lines = ["if not isinstance(value, basestring):",
+                 self.fail("must be a string")]
+        if self.nonempty:
+            lines.extend(["if not value:",
+                          self.fail("must be non-empty")])
+        return lines
+
+
+class PatternField(Field):
+    """A field whose value must be a string matching a regex."""
+
+    def __init__(self, name, regex, description, **kwds):
+        super(PatternField, self).__init__(name, **kwds)
+        self.regex = regex
+        self.description = description
+
+    def get_check_source(self, namespace):
+        regex_name = "%s_regex" % (self.name,)
+        namespace[regex_name] = self.regex
+        return ["if not isinstance(value, basestring) or "
+                "not %s.match(value):" % (regex_name,),
+                self.fail("must be " + self.description)]
+
+
+class IntegerField(Field):
+    """A field whose value must be an integer, such as a timestamp."""
+
+    def get_check_source(self, namespace):
+        return ["if not isinstance(value, (int, long)):",
+                self.fail("must be an integer")]
+
+
+class DictField(Field):
+    """A field whose value must be a dict."""
+
+    def get_check_source(self, namespace):
+        return ["if not isinstance(value, dict):",
+                self.fail("must be a dict")]
+
+
+class StringListField(Field):
+    """A field whose value must be a list of strings."""
+
+    def get_check_source(self, namespace):
+        return ["if not isinstance(value, list):",
+                self.fail("must be a list"),
+                "for item in value:",
+                "    if not isinstance(item, basestring):",
+                "    " + self.fail("must be a list of strings")]
+
+
+class ConstantField(Field):
+    """A field whose value, if present, must be one particular constant."""
+
+    def __init__(self, name, value, description, **kwds):
+        super(ConstantField, self).__init__(name, **kwds)
+        self.value = value
+        self.description = description
+
+    def get_check_source(self, namespace):
+        return ["if value != %r:" % (self.value,),
+                self.fail("must be " + self.description)]
+
+
+def compile_validator(name, schema):
+    """Compile a record schema into a specialized validate() function."""
+    namespace = {}
+    lines = ["def validate(self):"]
+    for field in schema:
+        lines.extend("    " + ln for ln in field.get_source(namespace))
+    lines.append("    return True, None")
+    code = compile("\n".join(lines), "<%s.validate>" % (name,), "exec")
+    exec code in namespace
+    return namespace["validate"]
+
+
+class RecordType(type):
+    """Metaclass that builds each Record class from its declared SCHEMA.
+
+    The class gets a FIELDS set of its field names, a slot for each of
+    them, and a validate() method compiled from the field declarations.
+    """
+
+    def __new__(mcls, name, bases, attrs):
+        schema = attrs.get("SCHEMA")
+        if schema is not None:
+            names = tuple(field.name for field in schema)
+            attrs["FIELDS"] = frozenset(names)
+            attrs["__slots__"] = names
+            attrs["validate"] = compile_validator(name, schema)
+        return super(RecordType, mcls).__new__(mcls, name, bases, attrs)
+
+
+class Record(object):
+    """Base class for dealing with different types of record.
 
-    FIELDS = set()
+    Each record type keeps its known fields in __slots__ rather than in a
+    per-instance dict, but supports the dict-style item access used by the
+    rest of the code.  Unknown fields are only kept if the record is told
+    to ignore them, in a separate dict that is usually left empty.  Fields
+    that are missing or None are left out of the to_dict() form.
+
+    Subclasses declare their fields in SCHEMA, from which RecordType sets
+    up FIELDS, the slots and the validate() method.
+    """
+
+    __metaclass__ = RecordType
+
+    __slots__ = ("_extra",)
+
+    SCHEMA = None
+
+    FIELDS = frozenset()
+
+    # Name of the field recording when the item was first stored.
+    CREATED_FIELD = None
+
+    # Name of the field from which the item's id is derived.
+    ID_FIELD = None
 
     def __init__(self, data=None, ignore_unknown_fields=False):
-        super(Record, self).__init__()
+        self._extra = None
         if data is None:
-            data = {}
+            return
 
         try:
             data_items = data.items()
@@ -37,17 +209,107 @@ class Record(dict):
             raise ValueError(msg % (cls_name, type(data),))
 
         for name, value in data_items:
-            if name not in self.FIELDS and not ignore_unknown_fields:
+            if name in self.FIELDS:
+                if value is not None:
+                    setattr(self, name, value)
+            elif not ignore_unknown_fields:
                 cls_name = self.__class__.__name__
                 raise ValueError("Unknown %s field %r" % (cls_name, name,))
-            if value is not None:
-                self[name] = value
+            elif value is not None:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[name] = value
+
+    def __getitem__(self, name):
+        if name in self.FIELDS:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                raise KeyError(name)
+        if self._extra is None:
+            raise KeyError(name)
+        return self._extra[name]
+
+    def __setitem__(self, name, value):
+        if name in self.FIELDS:
+            setattr(self, name, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[name] = value
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.to_dict())
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def items(self):
+        items = []
+        for name in self.FIELDS:
+            try:
+                items.append((name, getattr(self, name)))
+            except AttributeError:
+                pass
+        if self._extra:
+            items.extend(self._extra.iteritems())
+        return items
+
+    def to_dict(self):
+        return dict(self.items())
 
     def get_id(self):
         raise NotImplementedError  # pragma: nocover
 
-    def populate(self, request, old_item=None):
+    def content_hash(self):
+        """Get a hash of the record's content, ignoring its timestamps.
+
+        Two copies of a record that differ only in when they were created
+        or last modified will give the same hash.
+        """
+        data = self.to_dict()
+        data.pop("modifiedAt", None)
+        data.pop(self.CREATED_FIELD, None)
+        return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def make_tombstone(cls, data, deleted_at):
+        """Make the data left in place of a record when it is deleted.
+
+        This identifies the deleted record in the same way that the record
+        itself did, so that clients can tell which one was deleted.  Its
+        modifiedAt is the time of the delete, like for any other change.
+        """
+        return {
+            cls.ID_FIELD: data.get(cls.ID_FIELD),
+            "deleted": True,
+            "deletedAt": deleted_at,
+            "modifiedAt": deleted_at,
+        }
+
+    def populate(self, request, created=None):
         self["modifiedAt"] = request.server_time
+        if created is None:
+            created = request.server_time
+        self[self.CREATED_FIELD] = created
 
     def abbreviate(self):
         raise NotImplementedError  # pragma: nocover
@@ -59,107 +321,50 @@ class Record(dict):
 class AppRecord(Record):
     """Class for working with App record data."""
 
-    FIELDS = set(("origin", "manifestPath", "installOrigin", "installedAt",
-                  "modifiedAt", "name", "hidden", "receipts"))
+    SCHEMA = (
+        StringField("origin"),
+        StringField("manifestPath"),
+        StringField("installOrigin"),
+        StringField("name"),
+        IntegerField("installedAt"),
+        IntegerField("modifiedAt"),
+        StringListField("receipts"),
+        ConstantField("hidden", True, "boolean true", required=False),
+    )
+
+    CREATED_FIELD = "installedAt"
+
+    ID_FIELD = "origin"
 
     def get_id(self):
         return origin_to_id(self["origin"])
 
-    def populate(self, request, old_item=None):
-        super(AppRecord, self).populate(request, old_item)
-        if old_item is not None:
-            self["installedAt"] = old_item["installedAt"]
-        else:
-            self["installedAt"] = request.server_time
-
     def abbreviate(self):
         return {
             "origin": self["origin"],
             "modifiedAt": self["modifiedAt"],
         }
 
-    def validate(self):
-        # This catches KeyErrors, which indicate missing fields.
-        try:
-            # Check that paths are URL strings.
-            for field in ("origin", "manifestPath", "installOrigin"):
-                if not isinstance(self[field], basestring):
-                    return False, "%s must be a string" % (field,)
-
-            # Check that the name is a string.
-            field = "name"
-            if not isinstance(self[field], basestring):
-                return False, "name must be a string"
-
-            # Check that timestamps are integers.
-            for field in ("installedAt", "modifiedAt"):
-                if not isinstance(self[field], (int, long)):
-                    return False, "%s must be an integer" % (field,)
-
-            # Check that receipts is a list of strings.
-            field = "receipts"
-            receipts = self[field]
-            if not isinstance(receipts, list):
-                return False, "receipts must be a list"
-            for receipt in receipts:
-                if not isinstance(receipt, basestring):
-                    return False, "receipts must be a list of strings"
-
-            # Check that hidden, if present, is boolean true.
-            if self.get("hidden") not in (None, True):
-                return False, "hidden must be boolean true"
-        except KeyError:
-            return False, "missing field %r" % (field,)
-
-        return True, None
-
 
 class DeviceRecord(Record):
     """Class for working with Device record data."""
 
-    FIELDS = set(("uuid", "name", "type", "layout", "addedAt",
-                  "modifiedAt", "apps"))
+    SCHEMA = (
+        StringField("name", nonempty=True),
+        StringField("type", nonempty=True),
+        StringField("layout", nonempty=True),
+        IntegerField("addedAt"),
+        IntegerField("modifiedAt"),
+        PatternField("uuid", VALID_UUID_REGEX, "a valid UUID"),
+        DictField("apps"),
+    )
+
+    CREATED_FIELD = "addedAt"
+
+    ID_FIELD = "uuid"
 
     def get_id(self):
         return self["uuid"]
 
-    def populate(self, request, old_item=None):
-        super(DeviceRecord, self).populate(request, old_item)
-        if old_item is not None:
-            self["addedAt"] = old_item["addedAt"]
-        else:
-            self["addedAt"] = request.server_time
-
     def abbreviate(self):
-        abrv = self.copy()
-        abrv.pop("apps", None)
-        return abrv
-
-    def validate(self):
-        # This catches KeyErrors, which indicate missing fields.
-        try:
-            # Check that various fields are strings.
-            for field in ("name", "type", "layout"):
-                if not isinstance(self[field], basestring):
-                    return False, "%s must be a string" % (field,)
-                elif not self[field]:
-                    return False, "%s must be non-empty" % (field,)
-
-            # Check that timestamps are integers.
-            for field in ("addedAt", "modifiedAt"):
-                if not isinstance(self[field], (int, long)):
-                    return False, "%s must be an integer" % (field,)
-
-            # Check that uuid is valid and in proper format.
-            field = "uuid"
-            if not VALID_UUID_REGEX.match(self["uuid"]):
-                return False, "uuid must be a valid UUID"
-
-            # Check that apps is a dict
-            field = "apps"
-            if not isinstance(self["apps"], dict):
-                return False, "apps must be a dict"
-        except KeyError:
-            return False, "missing field %r" % (field,)
-
-        return True, None
+        return dict(item for item in self.items() if item[0] != "apps")
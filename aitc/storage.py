@@ -0,0 +1,708 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+AITC-specific operations on top of a SyncStorage backend.
+
+AITC records are stored as syncstorage BSOs, one collection per record
+type.  The helpers in this module know how records are laid out in the
+BSO payload and how to combine backend calls into single operations.
+"""
+
+import re
+import contextlib
+
+from syncstorage.storage import NotFoundError
+
+from aitc.jsoncodec import get_codec
+
+
+# Codec used by the functions below if they aren't given one.
+DEFAULT_CODEC = get_codec("simplejson")
+
+# Stands in for the content hash in the payloads of tombstones.
+TOMBSTONE_MARKER = "deleted"
+
+# Collection holding the number and total size of the tombstones in each
+# of a user's other collections, in an item named for that collection.
+TOMBSTONE_STATS_COLLECTION = "tombstones"
+
+# Columns of the BSO table that listings filtered by timestamp rely on
+# being indexed, in the order they need to appear in the index.
+MODIFIED_INDEX_COLUMNS = ("userid", "collection", "modified")
+
+# Regex matching the names of the BSO tables, which may be sharded.
+BSO_TABLE_REGEX = re.compile("^bso[0-9]*$")
+
+
+class OverQuotaError(Exception):
+    """Raised when a write is refused because the user is over quota."""
+
+
+class LockNotSupportedError(Exception):
+    """Raised when a backend can't lock a collection for writing."""
+
+
+def encode_payload(item, codec=DEFAULT_CODEC):
+    """Encode a record into the payload string stored in syncstorage.
+
+    The payload holds the JSON for the full record, the JSON for its
+    abbreviated form and the hash of its content, separated by newlines.
+    Encoded JSON never contains a raw newline, so the parts can be split
+    apart without any decoding.
+    """
+    full = codec.dumps(item.to_dict())
+    abbrev = codec.dumps(item.abbreviate())
+    return "%s\n%s\n%s" % (full, abbrev, item.content_hash())
+
+
+def encode_tombstone(tombstone, codec=DEFAULT_CODEC):
+    """Encode tombstone data into the payload string stored in syncstorage.
+
+    Tombstones are laid out like other payloads, but have the same data in
+    both their full and abbreviated forms, and a marker in place of their
+    content hash.
+    """
+    data = codec.dumps(tombstone)
+    return "%s\n%s\n%s" % (data, data, TOMBSTONE_MARKER)
+
+
+def is_tombstone(payload):
+    """Check whether a stored payload is the tombstone of a deleted item."""
+    return get_payload_hash(payload) == TOMBSTONE_MARKER
+
+
+def is_legacy_payload(payload):
+    """Check whether a payload predates storing the abbreviated form."""
+    return "\n" not in payload
+
+
+def split_payload(payload):
+    """Split a stored payload into its full and abbreviated JSON strings.
+
+    Payloads written before abbreviated forms were stored alongside the
+    record will give None for the abbreviated part.
+    """
+    full, _, rest = payload.partition("\n")
+    abbrev = rest.partition("\n")[0]
+    return full, (abbrev or None)
+
+
+def get_payload_hash(payload):
+    """Get the content hash from a stored payload, or None if it has none."""
+    parts = payload.split("\n", 2)
+    if len(parts) < 3:
+        return None
+    return parts[2]
+
+
+def get_collection_timestamp(storage, userid, collection):
+    """Get the last-modified time of a collection, or None if it's empty."""
+    try:
+        return storage.get_collection_timestamp(userid, collection)
+    except NotFoundError:
+        return None
+
+
+def get_item_page(storage, userid, collection, limit, newer=None,
+                  last_id=None):
+    """Get a page of the items in a collection, in (modified, id) order.
+
+    Pages are resumed from the (modified, id) of the last item on the
+    previous page, passed as newer and last_id, rather than from a position
+    in the listing.  So items rewritten between pages can't make others
+    shift into the part already read, and each page is an indexed query on
+    the modification time however far into the listing it is.
+
+    The backend only sorts by modification time, and items written in the
+    same batch share a timestamp.  Items with the same timestamp as the
+    last one on a page are all fetched and ordered by id, which is what
+    lets a page end part-way through them.
+
+    Returns a tuple (list of BSOs, whether there are more items).
+    """
+    if last_id is None:
+        bsos = []
+    else:
+        bsos = _get_items_modified_at(storage, userid, collection, newer,
+                                      last_id)
+    if len(bsos) <= limit:
+        res = storage.get_items(userid, collection, newer=newer,
+                                limit=limit - len(bsos) + 1, sort="oldest")
+        bsos.extend(res["items"])
+    if len(bsos) <= limit:
+        return bsos, False
+    last_modified = bsos[limit - 1]["modified"]
+    if last_id is not None and last_modified == newer:
+        after_id = last_id
+    else:
+        after_id = None
+    page = [bso for bso in bsos if bso["modified"] < last_modified]
+    page.extend(_get_items_modified_at(storage, userid, collection,
+                                       last_modified, after_id))
+    return page[:limit], True
+
+
+def iter_item_pages(storage, userid, collection, newer=None, page_size=100):
+    """Generate the items in a collection, a page of BSOs at a time.
+
+    This walks through the collection in order of modification time, using
+    the last item of each page to fetch the next one.
+    """
+    last_id = None
+    while True:
+        bsos, more = get_item_page(storage, userid, collection, page_size,
+                                   newer, last_id)
+        yield bsos
+        if not more:
+            break
+        newer = bsos[-1]["modified"]
+        last_id = bsos[-1]["id"]
+
+
+def check_quota(storage, userid):
+    """Raise OverQuotaError if the user has used up their storage quota.
+
+    This is the check that the SyncStorage controller makes before each
+    write, comparing the backend's total size for the user against its
+    quota_size.  Backends without a quota never refuse a write.
+    """
+    quota_size = getattr(storage, "quota_size", None)
+    if not quota_size:
+        return
+    if storage.get_total_size(userid) >= quota_size:
+        raise OverQuotaError(userid)
+
+
+@contextlib.contextmanager
+def write_lock(storage, userid, collection):
+    """Context manager to hold the backend's write lock on a collection.
+
+    Backends that provide lock_for_write() run all operations made while
+    holding the lock in a single session and transaction.  The writes in
+    this module read the stored items before replacing them, and would
+    race with each other without that, so other backends are refused
+    with LockNotSupportedError.
+    """
+    lock_for_write = getattr(storage, "lock_for_write", None)
+    if lock_for_write is None:
+        msg = "%s can't lock collections for writing" % (storage,)
+        raise LockNotSupportedError(msg)
+    with lock_for_write(userid, collection):
+        yield
+
+
+@contextlib.contextmanager
+def read_lock(storage, userid, *collections):
+    """Context manager to hold the backend's read lock on collections.
+
+    Backends that provide lock_for_read() run all operations made while
+    holding the locks in a single session and transaction, so they see a
+    consistent view of the collections.  For backends without it, this
+    does nothing.
+    """
+    lock_for_read = getattr(storage, "lock_for_read", None)
+    if lock_for_read is None or not collections:
+        yield
+    else:
+        with lock_for_read(userid, collections[0]):
+            with read_lock(storage, userid, *collections[1:]):
+                yield
+
+
+def upsert_record(storage, userid, collection, item_id, record,
+                  precondition=None, codec=DEFAULT_CODEC):
+    """Write a record, keeping the creation timestamp of any existing copy.
+
+    The record's creation timestamp field is overwritten with the value
+    from the stored copy if there is one, and left as-is otherwise.  The
+    optional precondition callable is given the existing BSO (or None)
+    before writing, and may raise an error to abort the write.  It all
+    happens under the collection write lock, in a single transaction, so
+    nothing can sneak in between the read and the write.  Backends that
+    can't lock give LockNotSupportedError rather than risk that.
+
+    If the stored copy has the same content as the record, apart from its
+    timestamps, then nothing is written.  Otherwise every client re-sending
+    an unchanged record would make all the other devices download it again.
+
+    Raises OverQuotaError, without writing anything, if the user is over
+    their storage quota.
+
+    Returns the backend's result dict from the write.  For a skipped write
+    this gives the existing item's timestamp, and "unchanged" is True.
+    """
+    with write_lock(storage, userid, collection):
+        old_bso = _get_item(storage, userid, collection, item_id)
+        tombstone = None
+        if old_bso is not None and is_tombstone(old_bso["payload"]):
+            tombstone, old_bso = old_bso, None
+        if precondition is not None:
+            precondition(old_bso)
+        if old_bso is not None:
+            if _is_unchanged(old_bso, record):
+                return {"created": False, "modified": old_bso["modified"],
+                        "unchanged": True}
+            _copy_created_timestamp(old_bso, record, codec)
+        check_quota(storage, userid)
+        bso = {"payload": encode_payload(record, codec)}
+        res = storage.set_item(userid, collection, item_id, bso)
+        # Replacing the tombstone of a deleted item creates it anew.
+        if old_bso is None:
+            res["created"] = True
+        if tombstone is not None:
+            _update_tombstone_stats(storage, userid, collection, [],
+                                    [tombstone["payload"]])
+        return res
+
+
+def delete_record(storage, userid, collection, item_id, record_class,
+                  deleted_at, precondition=None, codec=DEFAULT_CODEC):
+    """Delete a record, after checking a precondition against it.
+
+    The record is replaced by a tombstone, so that clients fetching the
+    changes to the collection find out that it was deleted.
+
+    As with upsert_record(), the precondition is given the existing BSO
+    (or None) under the collection write lock, and may raise an error to
+    abort the delete.  Raises NotFoundError if there is no such record.
+
+    Returns the modification timestamp of the delete.
+    """
+    with write_lock(storage, userid, collection):
+        old_bso = _get_live_item(storage, userid, collection, item_id)
+        if precondition is not None:
+            precondition(old_bso)
+        if old_bso is None:
+            raise NotFoundError(item_id)
+        bso = {"payload": _make_tombstone_payload(old_bso, record_class,
+                                                  deleted_at, codec)}
+        res = storage.set_item(userid, collection, item_id, bso)
+        _update_tombstone_stats(storage, userid, collection,
+                                [bso["payload"]], [])
+        return res["modified"]
+
+
+def delete_records(storage, userid, collection, record_class, deleted_at,
+                   ids=None, codec=DEFAULT_CODEC):
+    """Delete the records with the given ids, or all of them.
+
+    This is the batch version of delete_record(), leaving tombstones for
+    all the deleted records.  Ids of records that don't exist are ignored.
+
+    Returns the modification timestamp of the delete, or None if there
+    was nothing to delete.
+    """
+    with write_lock(storage, userid, collection):
+        try:
+            if ids is None:
+                old_bsos = storage.get_items(userid, collection)["items"]
+            else:
+                old_bsos = storage.get_items(userid, collection,
+                                             items=ids)["items"]
+        except NotFoundError:
+            old_bsos = []
+        bsos = []
+        for old_bso in old_bsos:
+            if not is_tombstone(old_bso["payload"]):
+                payload = _make_tombstone_payload(old_bso, record_class,
+                                                  deleted_at, codec)
+                bsos.append({"id": old_bso["id"], "payload": payload})
+        if not bsos:
+            return None
+        modified = storage.set_items(userid, collection, bsos)
+        _update_tombstone_stats(storage, userid, collection,
+                                [bso["payload"] for bso in bsos], [])
+        return modified
+
+
+def purge_tombstones(storage, userid, collection, before, batch_size=None,
+                     throttle=None):
+    """Delete the tombstones of items deleted before the given timestamp.
+
+    The tombstones are found with a single query, then deleted batch_size
+    at a time, so that big purges are split up into smaller transactions.
+    If given, the throttle callable is called before each query, e.g. to
+    limit the rate at which they're made.
+
+    Returns the number of tombstones purged.
+    """
+    return _purge_items(storage, userid, collection, before, True,
+                        batch_size, throttle)
+
+
+def purge_items(storage, userid, collection, before, batch_size=None,
+                throttle=None):
+    """Delete all the items last modified before the given timestamp.
+
+    This works like purge_tombstones(), but deletes live items as well.
+
+    Returns the number of items deleted, tombstones included.
+    """
+    return _purge_items(storage, userid, collection, before, False,
+                        batch_size, throttle)
+
+
+def upsert_records(storage, userid, collection, records,
+                   codec=DEFAULT_CODEC):
+    """Write several records at once, keeping existing creation timestamps.
+
+    This is the batch version of upsert_record().  The existing copies
+    are fetched in a single query and the changed records written with a
+    single set_items() call, all under the collection write lock.
+
+    Raises OverQuotaError, without writing anything, if the user is over
+    their storage quota.
+
+    Returns the modification timestamp of the write, or the collection's
+    current timestamp if none of the records had changed.
+    """
+    records_by_id = dict((record.get_id(), record) for record in records)
+    with write_lock(storage, userid, collection):
+        try:
+            old_bsos = storage.get_items(userid, collection,
+                                         items=records_by_id.keys())["items"]
+        except NotFoundError:
+            old_bsos = []
+        tombstones = []
+        for old_bso in old_bsos:
+            record = records_by_id[old_bso["id"]]
+            if is_tombstone(old_bso["payload"]):
+                tombstones.append(old_bso["payload"])
+            elif _is_unchanged(old_bso, record):
+                del records_by_id[old_bso["id"]]
+            else:
+                _copy_created_timestamp(old_bso, record, codec)
+        if not records_by_id:
+            return storage.get_collection_timestamp(userid, collection)
+        check_quota(storage, userid)
+        bsos = [{"id": item_id, "payload": encode_payload(record, codec)}
+                for (item_id, record) in records_by_id.iteritems()]
+        modified = storage.set_items(userid, collection, bsos)
+        _update_tombstone_stats(storage, userid, collection, [], tombstones)
+        return modified
+
+
+def get_tombstone_stats(storage, userid):
+    """Get the number and total size of the tombstones in each collection.
+
+    This returns a dict mapping collection names to dicts with "count"
+    and "bytes" keys, for collections that have had items deleted.
+    """
+    try:
+        bsos = storage.get_items(userid, TOMBSTONE_STATS_COLLECTION)["items"]
+    except NotFoundError:
+        return {}
+    return dict((bso["id"], DEFAULT_CODEC.loads(bso["payload"]))
+                for bso in bsos)
+
+
+def _get_item(storage, userid, collection, item_id):
+    """Get the stored BSO for an item, or None if there isn't one."""
+    try:
+        return storage.get_item(userid, collection, item_id)
+    except NotFoundError:
+        return None
+
+
+def _get_live_item(storage, userid, collection, item_id):
+    """Get the stored BSO for an item, or None if it doesn't exist.
+
+    Items that have been deleted, leaving only a tombstone, don't exist.
+    """
+    bso = _get_item(storage, userid, collection, item_id)
+    if bso is None or is_tombstone(bso["payload"]):
+        return None
+    return bso
+
+
+def _update_tombstone_stats(storage, userid, collection, added, removed):
+    """Account for tombstones added to and removed from a collection.
+
+    This takes the payloads of the tombstones written and of those that
+    were replaced or purged.  It must be called under the collection's
+    write lock, which keeps concurrent updates to its stats in order.
+    """
+    if not added and not removed:
+        return
+    try:
+        bso = storage.get_item(userid, TOMBSTONE_STATS_COLLECTION,
+                               collection)
+        stats = DEFAULT_CODEC.loads(bso["payload"])
+    except NotFoundError:
+        stats = {"count": 0, "bytes": 0}
+    stats["count"] += len(added) - len(removed)
+    stats["bytes"] += (sum(len(payload) for payload in added) -
+                       sum(len(payload) for payload in removed))
+    if stats["count"] <= 0:
+        storage.delete_items(userid, TOMBSTONE_STATS_COLLECTION,
+                             [collection])
+    else:
+        bso = {"payload": DEFAULT_CODEC.dumps(stats)}
+        storage.set_item(userid, TOMBSTONE_STATS_COLLECTION, collection, bso)
+
+
+def _get_items_modified_at(storage, userid, collection, modified,
+                           after_id=None):
+    """Get the items with exactly the given timestamp, ordered by id.
+
+    If given after_id, only items with a greater id are included.
+    """
+    bsos = storage.get_items(userid, collection, newer=modified - 1,
+                             older=modified + 1)["items"]
+    if after_id is not None:
+        bsos = [bso for bso in bsos if bso["id"] > after_id]
+    bsos.sort(key=lambda bso: bso["id"])
+    return bsos
+
+
+def _purge_items(storage, userid, collection, before, tombstones_only,
+                 batch_size, throttle):
+    """Delete old items from a collection, in batches.
+
+    Each batch is checked again under the write lock before deleting it,
+    so that items written since they were found are left alone.
+    """
+    if throttle is not None:
+        throttle()
+    try:
+        bsos = storage.get_items(userid, collection, older=before)["items"]
+    except NotFoundError:
+        return 0
+    if tombstones_only:
+        bsos = [bso for bso in bsos if is_tombstone(bso["payload"])]
+    ids = [bso["id"] for bso in bsos]
+    if batch_size is None:
+        batch_size = max(len(ids), 1)
+    num_deleted = 0
+    for i in xrange(0, len(ids), batch_size):
+        if throttle is not None:
+            throttle()
+        with write_lock(storage, userid, collection):
+            try:
+                bsos = storage.get_items(userid, collection, older=before,
+                                         items=ids[i:i + batch_size])["items"]
+            except NotFoundError:
+                break
+            tombstones = [bso["payload"] for bso in bsos
+                          if is_tombstone(bso["payload"])]
+            if tombstones_only:
+                bsos = [bso for bso in bsos if is_tombstone(bso["payload"])]
+            if bsos:
+                storage.delete_items(userid, collection,
+                                     [bso["id"] for bso in bsos])
+                _update_tombstone_stats(storage, userid, collection, [],
+                                        tombstones)
+            num_deleted += len(bsos)
+    return num_deleted
+
+
+def _make_tombstone_payload(old_bso, record_class, deleted_at, codec):
+    """Make the payload of the tombstone that replaces a stored BSO."""
+    old_data = codec.loads(split_payload(old_bso["payload"])[0])
+    tombstone = record_class.make_tombstone(old_data, deleted_at)
+    return encode_tombstone(tombstone, codec)
+
+
+def _is_unchanged(old_bso, record):
+    """Check whether a stored BSO has the same content as a record.
+
+    Payloads written before content hashes were stored never match, so
+    they get rewritten in the current format.
+    """
+    return get_payload_hash(old_bso["payload"]) == record.content_hash()
+
+
+def _copy_created_timestamp(old_bso, record, codec):
+    """Copy the creation timestamp from a stored BSO into a record."""
+    old_item = codec.loads(split_payload(old_bso["payload"])[0])
+    created = old_item.get(record.CREATED_FIELD)
+    if created is not None:
+        record[record.CREATED_FIELD] = created
+
+
+def find_missing_indexes(storage):
+    """Find the BSO tables lacking an index for listings by timestamp.
+
+    Listings using "after" filter on the modification time of the items
+    in a user's collection, which is only fast if there's an index over
+    MODIFIED_INDEX_COLUMNS.  This reflects the tables of a SQL backend
+    to check for one, and returns the list of tables without it.  Wrapped
+    backends are checked by looking through to the one underneath.  For
+    backends not backed by SQL, there's nothing to check.
+    """
+    dbconnector = _get_dbconnector(storage)
+    if dbconnector is None:
+        return []
+    missing = []
+    for table in _reflect_bso_tables(dbconnector.engine):
+        if not all(column in table.c for column in MODIFIED_INDEX_COLUMNS):
+            continue
+        for index in table.indexes:
+            columns = tuple(column.name for column in index.columns)
+            if columns[:len(MODIFIED_INDEX_COLUMNS)] == MODIFIED_INDEX_COLUMNS:
+                break
+        else:
+            missing.append(table)
+    return missing
+
+
+def create_missing_indexes(storage):
+    """Create any missing indexes needed for listings by timestamp.
+
+    Returns the names of the tables that an index was created on.
+    """
+    from sqlalchemy import Index
+    created = []
+    for table in find_missing_indexes(storage):
+        columns = [table.c[column] for column in MODIFIED_INDEX_COLUMNS]
+        index = Index("%s_usr_col_mod" % (table.name,), *columns)
+        index.create(bind=_get_dbconnector(storage).engine)
+        created.append(table.name)
+    return created
+
+
+def backfill_payloads(storage, userid, collection, record_class,
+                      codec=DEFAULT_CODEC, batch_size=None, throttle=None):
+    """Rewrite a collection's legacy payloads in the current format.
+
+    Items written before the abbreviated form and content hash were stored
+    alongside them have to be decoded and abbreviated on every listing.
+    This adds those parts to their payloads without changing the stored
+    JSON or the items' timestamps, so clients don't see them as changed.
+    The storage API would give every rewritten item a new timestamp, so
+    this updates the BSO tables of a SQL backend directly, and does
+    nothing for other backends.  A SQL backend wrapped by MemcachedStorage
+    is updated underneath it, so the collection sizes it has cached will
+    read a little low until they are next recalculated.
+
+    Each row is only updated if it still holds the payload that was read,
+    so items written in the meantime are left alone.  The batch_size and
+    throttle arguments work as for purge_tombstones().
+
+    Returns the number of items rewritten.
+    """
+    dbconnector = _get_dbconnector(storage)
+    if dbconnector is None:
+        return 0
+    from sqlalchemy import and_
+    if throttle is not None:
+        throttle()
+    try:
+        bsos = storage.get_items(userid, collection)["items"]
+    except NotFoundError:
+        return 0
+    bsos = [bso for bso in bsos if is_legacy_payload(bso["payload"])]
+    if batch_size is None:
+        batch_size = max(len(bsos), 1)
+    engine = dbconnector.engine
+    tables = _reflect_bso_tables(engine)
+    num_rewritten = 0
+    for i in xrange(0, len(bsos), batch_size):
+        if throttle is not None:
+            throttle()
+        for bso in bsos[i:i + batch_size]:
+            data = codec.loads(bso["payload"])
+            item = record_class(data, ignore_unknown_fields=True)
+            payload = "%s\n%s\n%s" % (bso["payload"],
+                                       codec.dumps(item.abbreviate()),
+                                       item.content_hash())
+            for table in tables:
+                collection_key = _get_collection_key(engine, table,
+                                                     collection)
+                if collection_key is None:
+                    continue
+                values = {"payload": payload}
+                if "payload_size" in table.c:
+                    values["payload_size"] = len(payload)
+                query = table.update().values(**values).where(and_(
+                    table.c.userid == userid,
+                    table.c.collection == collection_key,
+                    table.c.id == bso["id"],
+                    table.c.payload == bso["payload"]))
+                if engine.execute(query).rowcount:
+                    num_rewritten += 1
+                    break
+    return num_rewritten
+
+
+def iter_userids(storage, start_userid, end_userid, batch_size=1000,
+                 throttle=None):
+    """Generate the userids in a range that may have any stored items.
+
+    For a SQL backend, this pages through the distinct userids in its BSO
+    tables, batch_size at a time, so that users who never stored anything
+    cost nothing.  Other backends can't list their users, so this gives
+    every userid in the range.  The throttle is called before each query,
+    as for purge_tombstones().
+    """
+    dbconnector = _get_dbconnector(storage)
+    if dbconnector is None:
+        for userid in xrange(start_userid, end_userid + 1):
+            yield userid
+        return
+    from sqlalchemy import and_, select
+    engine = dbconnector.engine
+    tables = _reflect_bso_tables(engine)
+    last_userid = start_userid - 1
+    while True:
+        if throttle is not None:
+            throttle()
+        userids = set()
+        for table in tables:
+            query = select([table.c.userid], and_(
+                table.c.userid > last_userid,
+                table.c.userid <= end_userid))
+            query = query.distinct().order_by(table.c.userid)
+            query = query.limit(batch_size)
+            userids.update(row[0] for row in engine.execute(query))
+        userids = sorted(userids)[:batch_size]
+        for userid in userids:
+            yield userid
+        if len(userids) < batch_size:
+            break
+        last_userid = userids[-1]
+
+
+def _get_dbconnector(storage):
+    """Get the database connector of a SQL backend, or None.
+
+    Backends wrapped by another one, like MemcachedStorage, are found
+    through the wrapper's "storage" attribute.
+    """
+    while storage is not None:
+        dbconnector = getattr(storage, "dbconnector", None)
+        if dbconnector is not None:
+            return dbconnector
+        storage = getattr(storage, "storage", None)
+    return None
+
+
+def _get_collection_key(engine, table, collection):
+    """Get the value identifying a collection in a BSO table's rows.
+
+    SQL backends may store collections by name, or by an integer id that
+    is looked up in their "collections" table.  Gives None if the
+    collection doesn't have an id, so can't have any rows.
+    """
+    from sqlalchemy import Integer, MetaData, select
+    if not isinstance(table.c.collection.type, Integer):
+        return collection
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=["collections"])
+    collections = metadata.tables["collections"]
+    query = select([collections.c.collectionid],
+                   collections.c.name == collection)
+    return engine.execute(query).scalar()
+
+
+def _reflect_bso_tables(engine):
+    """Get SQLAlchemy Table objects for all of a SQL backend's BSO tables."""
+    from sqlalchemy import MetaData
+    names = [name for name in engine.table_names()
+             if BSO_TABLE_REGEX.match(name)]
+    if not names:
+        return []
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=names)
+    return [metadata.tables[name] for name in names]
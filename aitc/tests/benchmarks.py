@@ -0,0 +1,251 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Micro-benchmarks for the performance-sensitive parts of AITC.
+
+These are not run as part of the test suite.  Run them from the
+command-line like so:
+
+    python -m aitc.tests.benchmarks [name ...]
+
+With no arguments, all of the registered benchmarks are run.
+
+"""
+
+import sys
+import timeit
+
+import simplejson as json
+
+from aitc.records import AppRecord, DeviceRecord, VALID_UUID_REGEX
+from aitc.storage import encode_payload
+from aitc.controller import render_json_list
+from aitc.jsoncodec import get_codec, get_available_codecs
+
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """Decorator to register a function in the list of benchmarks."""
+    BENCHMARKS.append(func)
+    return func
+
+
+def best_time(func, repeat=3, number=10):
+    """Get the best per-call time for the given function, in seconds."""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def report(title, baseline, *timings):
+    """Print a line comparing each named timing against the baseline."""
+    base_name, base_time = baseline
+    line = "%s: %s %.3fms" % (title, base_name, base_time * 1000)
+    for name, time in timings:
+        line += ", %s %.3fms (%.1fx)" % (name, time * 1000, base_time / time)
+    print line
+
+
+def make_app_data(num):
+    """Make some representative app data for benchmarking."""
+    return {
+        "origin": "https://example%d.com" % (num,),
+        "manifestPath": "/manifest.webapp",
+        "installOrigin": "https://marketplace.mozilla.org",
+        "installedAt": 1330535996745 + num,
+        "modifiedAt": 1330535996945 + num,
+        "name": "Examplinator %d" % (num,),
+        "receipts": ["receipt-%d-%d" % (num, i) for i in xrange(3)],
+    }
+
+
+def make_device_data(num):
+    """Make some representative device data for benchmarking."""
+    return {
+        "uuid": "75B538D8-67AF-44E8-86A0-%012d" % (num,),
+        "name": "Device %d" % (num,),
+        "type": "mobile",
+        "layout": "android/phone",
+        "addedAt": 1330535996745 + num,
+        "modifiedAt": 1330535996945 + num,
+        "apps": dict(("app%d" % (i,), "data") for i in xrange(20)),
+    }
+
+
+@benchmark
+def full_listing(sizes=(100, 500, 1000)):
+    """Full collection listings: decode/re-encode versus splicing."""
+    for size in sizes:
+        payloads = [json.dumps(make_app_data(i)) for i in xrange(size)]
+
+        def reencode():
+            items = [json.loads(payload) for payload in payloads]
+            return json.dumps({"apps": items})
+
+        def splice():
+            return render_json_list("apps", payloads)
+
+        assert json.loads(reencode()) == json.loads(splice())
+        report("full listing of %d apps" % (size,),
+               ("decode/encode", best_time(reencode)),
+               ("splice", best_time(splice)))
+
+
+@benchmark
+def put_encoding():
+    """PUT body handling: the JSON work saved by skipping the BSO body.
+
+    This only times building and encoding the payload, not the request
+    handling or the write itself; see "putting an app" in dbbench for
+    both PUT paths timed against a real database.
+    """
+    body = json.dumps(make_app_data(1))
+
+    def via_bso_body():
+        item = AppRecord(json.loads(body))
+        bso_body = json.dumps({"payload": encode_payload(item)})
+        return json.loads(bso_body)["payload"]
+
+    def direct():
+        item = AppRecord(json.loads(body))
+        return encode_payload(item)
+
+    assert via_bso_body() == direct()
+    report("encoding a PUT of one app",
+           ("via BSO body", best_time(via_bso_body, number=1000)),
+           ("direct", best_time(direct, number=1000)))
+
+
+@benchmark
+def records(num=10000):
+    """Building, validating and abbreviating records in bulk."""
+    for RecordClass, make_data in ((AppRecord, make_app_data),
+                                   (DeviceRecord, make_device_data)):
+        datas = [make_data(i) for i in xrange(num)]
+        items = [RecordClass(data) for data in datas]
+        name = RecordClass.__name__
+        for title, func in (
+            ("build", lambda: [RecordClass(data) for data in datas]),
+            ("validate", lambda: [item.validate() for item in items]),
+            ("abbreviate", lambda: [item.abbreviate() for item in items]),
+        ):
+            time = best_time(func, number=1)
+            print "%s: %s %d records in %.1fms (%d/s)" % (
+                  name, title, num, time * 1000, num / time)
+        # Compare the size of the record object itself to the size of a
+        # dict holding the same data, which is what Record used to be.
+        item_size = sys.getsizeof(items[0])
+        dict_size = sys.getsizeof(dict(datas[0]))
+        print "%s: %d bytes per record, versus %d bytes as a dict" % (
+              name, item_size, dict_size)
+
+
+def handwritten_app_validate(self):
+    """The hand-written AppRecord.validate, kept for comparison."""
+    try:
+        for field in ("origin", "manifestPath", "installOrigin"):
+            if not isinstance(self[field], basestring):
+                return False, "%s must be a string" % (field,)
+        field = "name"
+        if not isinstance(self[field], basestring):
+            return False, "name must be a string"
+        for field in ("installedAt", "modifiedAt"):
+            if not isinstance(self[field], (int, long)):
+                return False, "%s must be an integer" % (field,)
+        field = "receipts"
+        receipts = self[field]
+        if not isinstance(receipts, list):
+            return False, "receipts must be a list"
+        for receipt in receipts:
+            if not isinstance(receipt, basestring):
+                return False, "receipts must be a list of strings"
+        if self.get("hidden") not in (None, True):
+            return False, "hidden must be boolean true"
+    except KeyError:
+        return False, "missing field %r" % (field,)
+    return True, None
+
+
+def handwritten_device_validate(self):
+    """The hand-written DeviceRecord.validate, kept for comparison."""
+    try:
+        for field in ("name", "type", "layout"):
+            if not isinstance(self[field], basestring):
+                return False, "%s must be a string" % (field,)
+            elif not self[field]:
+                return False, "%s must be non-empty" % (field,)
+        for field in ("addedAt", "modifiedAt"):
+            if not isinstance(self[field], (int, long)):
+                return False, "%s must be an integer" % (field,)
+        field = "uuid"
+        if not VALID_UUID_REGEX.match(self["uuid"]):
+            return False, "uuid must be a valid UUID"
+        field = "apps"
+        if not isinstance(self["apps"], dict):
+            return False, "apps must be a dict"
+    except KeyError:
+        return False, "missing field %r" % (field,)
+    return True, None
+
+
+@benchmark
+def validation(num=10000):
+    """Compiled schema validators versus the old hand-written ones."""
+    for RecordClass, make_data, handwritten in (
+        (AppRecord, make_app_data, handwritten_app_validate),
+        (DeviceRecord, make_device_data, handwritten_device_validate),
+    ):
+        good = [RecordClass(make_data(i)) for i in xrange(num)]
+        # Records missing their last-checked field fail as late as possible.
+        last_field = RecordClass.SCHEMA[-1].name
+        if not RecordClass.SCHEMA[-1].required:
+            last_field = RecordClass.SCHEMA[-2].name
+        bad = []
+        for i in xrange(num):
+            data = make_data(i)
+            del data[last_field]
+            bad.append(RecordClass(data))
+        for title, items in (("valid", good), ("invalid", bad)):
+            for item in items[:10]:
+                assert handwritten(item) == item.validate()
+            report("%s: validate %d %s records" % (RecordClass.__name__,
+                                                  num, title),
+                   ("hand-written",
+                    best_time(lambda: map(handwritten, items), number=1)),
+                   ("compiled",
+                    best_time(lambda: [i.validate() for i in items],
+                              number=1)))
+
+
+@benchmark
+def json_codecs(num=100):
+    """Decoding and encoding app and device data with each JSON codec."""
+    print "auto codec: %s" % (get_codec("auto").name,)
+    codecs = get_available_codecs()
+    for name, make_data in (("apps", make_app_data),
+                            ("devices", make_device_data)):
+        datas = [make_data(i) for i in xrange(num)]
+        bodies = [json.dumps(data) for data in datas]
+        for title, make_func in (
+            ("decode", lambda c: lambda: [c.loads(b) for b in bodies]),
+            ("encode", lambda c: lambda: [c.dumps(d) for d in datas]),
+        ):
+            timings = [(codec.name, best_time(make_func(codec), number=100))
+                       for codec in codecs]
+            baseline = [t for t in timings if t[0] == "simplejson"][0]
+            others = [t for t in timings if t[0] != "simplejson"]
+            report("%s %d %s" % (title, num, name), baseline, *others)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    for func in BENCHMARKS:
+        if not args or func.__name__ in args:
+            func()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Query latency benchmark for AITC against a large sqlite database.
+
+This fills a local sqlite database with synthetic app and device records
+for many users, then reports the median and 99th percentile latencies of
+full listings, "after" polls and single-item PUTs for randomly-chosen
+users.  PUTs are timed both as AITCController.set_item does them now
+and the way it used to, by handing a BSO body on to the SyncStorage
+backend.  It is not run as part of the test suite.  Run it like so:
+
+    python -m aitc.tests.dbbench --users=25000 /tmp/aitc-bench.db
+
+The defaults give about a million rows, which takes a while to write; an
+existing database file is re-used as-is, so it only has to be filled once.
+Pass --no-index to drop the (userid, collection, modified) index first and
+see how the "after" polls fare without it.
+
+"""
+
+import os
+import sys
+import time
+import random
+import optparse
+
+import simplejson as json
+
+from syncstorage.storage import NotFoundError
+from syncstorage.storage.sql import SQLStorage
+
+from aitc.records import AppRecord, DeviceRecord
+from aitc.storage import (encode_payload,
+                          split_payload,
+                          upsert_record,
+                          check_quota,
+                          create_missing_indexes,
+                          MODIFIED_INDEX_COLUMNS)
+from aitc.controller import render_json_list
+from aitc.tests.benchmarks import make_app_data, make_device_data
+
+
+def percentile(timings, pct):
+    """Get the given percentile of a sorted list of timings."""
+    return timings[int(round((len(timings) - 1) * pct / 100.0))]
+
+
+def report(title, timings):
+    """Print the p50 and p99 of a list of timings, in milliseconds."""
+    timings = sorted(timings)
+    print "%s: p50 %.3fms, p99 %.3fms (%d samples)" % (
+        title, percentile(timings, 50) * 1000,
+        percentile(timings, 99) * 1000, len(timings))
+
+
+def fill_database(storage, num_users, num_apps, num_devices):
+    """Write the synthetic records for each user, one batch per collection."""
+    for userid in xrange(1, num_users + 1):
+        for collection, record_class, make_data, num in (
+            ("apps", AppRecord, make_app_data, num_apps),
+            ("devices", DeviceRecord, make_device_data, num_devices),
+        ):
+            records = [record_class(make_data(i)) for i in xrange(num)]
+            bsos = [{"id": record.get_id(), "payload": encode_payload(record)}
+                    for record in records]
+            storage.set_items(userid, collection, bsos)
+        if userid % 1000 == 0:
+            print "filled %d of %d users" % (userid, num_users)
+
+
+def drop_modified_indexes(storage):
+    """Drop any indexes that would back listings by timestamp."""
+    from sqlalchemy import MetaData
+    engine = storage.dbconnector.engine
+    metadata = MetaData()
+    metadata.reflect(bind=engine)
+    for table in metadata.tables.itervalues():
+        for index in list(table.indexes):
+            columns = tuple(column.name for column in index.columns)
+            if columns[:len(MODIFIED_INDEX_COLUMNS)] == MODIFIED_INDEX_COLUMNS:
+                index.drop(bind=engine)
+
+
+def time_call(func, *args):
+    """Call the given function, returning how long it took in seconds."""
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def get_listing(storage, userid, collection):
+    bsos = storage.get_items(userid, collection)["items"]
+    render_json_list(collection,
+                     [split_payload(bso["payload"])[1] for bso in bsos])
+
+
+def poll_after(storage, userid, collection):
+    # Devices poll with the timestamp from their last sync, which for most
+    # of them means there's nothing new to find.
+    ts = storage.get_collection_timestamp(userid, collection)
+    bsos = storage.get_items(userid, collection, newer=ts)["items"]
+    render_json_list(collection,
+                     [split_payload(bso["payload"])[1] for bso in bsos])
+
+
+def make_put_body(num):
+    data = make_app_data(num)
+    # Change the content as well as the timestamp, so that the write isn't
+    # skipped as a no-op.
+    data["modifiedAt"] = int(time.time() * 1000)
+    data["name"] = "Renamed %d" % (data["modifiedAt"],)
+    return json.dumps(data)
+
+
+def put_app(storage, userid, num):
+    app = AppRecord(json.loads(make_put_body(num)))
+    app.validate()
+    upsert_record(storage, userid, "apps", app.get_id(), app)
+
+
+def put_app_via_bso(storage, userid, num):
+    # The old PUT path: read the stored item to carry its installedAt
+    # over, then re-encode the record as a BSO body, which the SyncStorage
+    # controller parsed again and checked against the quota before
+    # writing it as-is.
+    app = AppRecord(json.loads(make_put_body(num)))
+    try:
+        old_bso = storage.get_item(userid, "apps", app.get_id())
+    except NotFoundError:
+        pass
+    else:
+        old_data = json.loads(split_payload(old_bso["payload"])[0])
+        app["installedAt"] = old_data["installedAt"]
+    app.validate()
+    bso_body = json.dumps({"payload": encode_payload(app)})
+    bso = json.loads(bso_body)
+    check_quota(storage, userid)
+    storage.set_item(userid, "apps", app.get_id(), bso)
+
+
+def main(args=None):
+    usage = "usage: %prog [options] sqlite_file"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--users", type="int", default=25000,
+                      help="number of users to fill the database with")
+    parser.add_option("--apps", type="int", default=40,
+                      help="number of apps per user")
+    parser.add_option("--devices", type="int", default=2,
+                      help="number of devices per user")
+    parser.add_option("--samples", type="int", default=1000,
+                      help="number of requests of each kind to time")
+    parser.add_option("--no-index", action="store_true",
+                      help="drop the index backing listings by timestamp")
+
+    if args is None:
+        args = sys.argv[1:]
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("you must specify a sqlite file")
+
+    path = os.path.abspath(args[0])
+    exists = os.path.exists(path)
+    storage = SQLStorage("sqlite:///" + path, create_tables=True)
+    if not exists:
+        fill_database(storage, opts.users, opts.apps, opts.devices)
+    if opts.no_index:
+        drop_modified_indexes(storage)
+    else:
+        create_missing_indexes(storage)
+
+    num_users = opts.users
+    userids = [random.randint(1, num_users) for _ in xrange(opts.samples)]
+    report("listing apps",
+           [time_call(get_listing, storage, userid, "apps")
+            for userid in userids])
+    report("polling apps after",
+           [time_call(poll_after, storage, userid, "apps")
+            for userid in userids])
+    report("polling devices after",
+           [time_call(poll_after, storage, userid, "devices")
+            for userid in userids])
+    report("putting an app via a BSO body",
+           [time_call(put_app_via_bso, storage, userid,
+                      random.randint(0, opts.apps))
+            for userid in userids])
+    report("putting an app",
+           [time_call(put_app, storage, userid, random.randint(0, opts.apps))
+            for userid in userids])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,18 +18,37 @@ import unittest2
 
 import os
 import sys
+import gzip
 import time
+import StringIO
 import webtest
 
+import simplejson as json
+
 from mozsvc.exceptions import BackendError
 
 from syncstorage.tests.support import restore_env
 from syncstorage.tests.functional.support import run_live_functional_tests
 
+from aitc.controller import MAX_ITEM_SIZE
 from aitc.records import origin_to_id
 from aitc.tests.functional.support import AITCFunctionalTestCase
 
 
+def gzip_compress(data):
+    """Compress a string in gzip format."""
+    buf = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode="wb")
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+def gzip_decompress(data):
+    """Decompress a gzip-format string."""
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+
 TEST_APP_DATA = {
     "origin": "https://example.com",
     "manifestPath": "/manifest.webapp",
@@ -74,10 +93,12 @@ class TestAITC(AITCFunctionalTestCase):
         self.assertEquals(devices, [])
 
     def test_that_only_defined_collection_names_are_available(self):
-        # SyncStorage creates collections on first read, so this fails.
-        #self.app.get(self.root + "/foo", status=404)
-        #self.app.get(self.root + "/foo/", status=404)
-        pass
+        self.app.get(self.root + "/foo", status=404)
+        self.app.get(self.root + "/foo/", status=404)
+        self.app.get(self.root + "/foo/bar", status=404)
+        # Our own bookkeeping collections aren't exposed either.
+        self.app.get(self.root + "/tombstones/", status=404)
+        self.app.get(self.root + "/tombstones/apps", status=404)
 
     def test_that_syncstorage_urls_do_not_leak_through(self):
         self.app.get(self.root + "/info/collections", status=404)
@@ -100,11 +121,13 @@ class TestAITC(AITCFunctionalTestCase):
         id = origin_to_id(data["origin"])
         app1 = self.app.get(self.root + "/apps/" + id).json
         self.assertEquals(app1["origin"], data["origin"])
-        # Writing it again updates the modified time.
+        # Writing it again with new content updates the modified time.
         time.sleep(0.01)
+        data["name"] = "Examplinator 4000"
         self.app.put_json(self.root + "/apps/" + id, data)
         app2 = self.app.get(self.root + "/apps/" + id).json
         self.assertEquals(app2["origin"], data["origin"])
+        self.assertEquals(app2["name"], data["name"])
         self.assertEquals(app2["installedAt"], app1["installedAt"])
         self.assertGreater(app2["modifiedAt"], app1["modifiedAt"])
         # Deleting it makes it go away.
@@ -128,8 +151,9 @@ class TestAITC(AITCFunctionalTestCase):
         device1 = self.app.get(self.root + "/devices/" + data["uuid"]).json
         self.assertEquals(device1["uuid"], data["uuid"])
         self.assertEquals(device1["layout"], data["layout"])
-        # Writing it again updates the modified time.
+        # Writing it again with new content updates the modified time.
         time.sleep(0.01)
+        data["name"] = "Renamed Device"
         self.app.put_json(self.root + "/devices/" + data["uuid"], data)
         device2 = self.app.get(self.root + "/devices/" + data["uuid"]).json
         self.assertEquals(device2["uuid"], data["uuid"])
@@ -148,9 +172,14 @@ class TestAITC(AITCFunctionalTestCase):
         self.app.put_json(self.root + "/apps/" + id, data)
         app1 = self.app.get(self.root + "/apps/" + id).json
         self.assertEquals(app1["installedAt"], app1["modifiedAt"])
-        # On subsequent writes, only the modified timestamp is set.
+        # Re-writing the same content leaves the timestamps untouched.
         self.app.put_json(self.root + "/apps/" + id, app1)
         app2 = self.app.get(self.root + "/apps/" + id).json
+        self.assertEquals(app1, app2)
+        # On subsequent changes, only the modified timestamp is set.
+        data["name"] = "Examplinator 4000"
+        self.app.put_json(self.root + "/apps/" + id, data)
+        app2 = self.app.get(self.root + "/apps/" + id).json
         self.assertEquals(app1["installedAt"], app2["installedAt"])
         self.assertGreater(app2["modifiedAt"], app2["installedAt"])
 
@@ -161,9 +190,14 @@ class TestAITC(AITCFunctionalTestCase):
         self.app.put_json(self.root + "/devices/" + id, data)
         device1 = self.app.get(self.root + "/devices/" + id).json
         self.assertEquals(device1["addedAt"], device1["modifiedAt"])
-        # On subsequent writes, only the modified timestamp is set.
+        # Re-writing the same content leaves the timestamps untouched.
         self.app.put_json(self.root + "/devices/" + id, device1)
         device2 = self.app.get(self.root + "/devices/" + id).json
+        self.assertEquals(device1, device2)
+        # On subsequent changes, only the modified timestamp is set.
+        data["name"] = "Anant's Other Mac Pro"
+        self.app.put_json(self.root + "/devices/" + id, data)
+        device2 = self.app.get(self.root + "/devices/" + id).json
         self.assertEquals(device1["addedAt"], device2["addedAt"])
         self.assertGreater(device2["modifiedAt"], device2["addedAt"])
 
@@ -197,6 +231,102 @@ class TestAITC(AITCFunctionalTestCase):
         apps = self.app.get(self.root + "/apps/?after=" + str(ts2 + 1))
         self.assertEquals(len(apps.json["apps"]), 0)
 
+    def test_long_polling_for_changes_to_apps(self):
+        data = TEST_APP_DATA.copy()
+        id = origin_to_id(data["origin"])
+        r = self.app.put_json(self.root + "/apps/" + id, data)
+        ts = int(r.headers["X-Last-Modified"])
+        # If there are already changes, they're returned straight away.
+        start = time.time()
+        r = self.app.get(self.root + "/apps/?wait=5&after=" + str(ts - 1))
+        self.assertEquals(len(r.json["apps"]), 1)
+        self.assertTrue(time.time() - start < 5)
+        # Otherwise we wait for changes, and give up eventually.
+        start = time.time()
+        r = self.app.get(self.root + "/apps/?wait=1&after=" + str(ts))
+        self.assertEquals(len(r.json["apps"]), 0)
+        self.assertTrue(time.time() - start >= 1)
+        self.assertEquals(r.headers["X-Last-Modified"], str(ts))
+        # Invalid wait values give a 400.
+        self.app.get(self.root + "/apps/?wait=X&after=" + str(ts),
+                     status=400)
+
+    def test_listing_of_all_collections_at_once(self):
+        r = self.app.get(self.root + "/")
+        self.assertEquals(r.json, {"apps": [], "devices": []})
+        app = TEST_APP_DATA.copy()
+        r = self.app.put_json(self.root + "/apps/" +
+                              origin_to_id(app["origin"]), app)
+        ts1 = int(r.headers["X-Last-Modified"])
+        time.sleep(0.01)
+        device = TEST_DEVICE_DATA.copy()
+        r = self.app.put_json(self.root + "/devices/" + device["uuid"],
+                              device)
+        ts2 = int(r.headers["X-Last-Modified"])
+        # Without "full" we get the abbreviated forms.
+        r = self.app.get(self.root + "/")
+        self.assertEquals(r.headers["X-Last-Modified"], str(ts2))
+        self.assertEquals(len(r.json["apps"]), 1)
+        self.assertEquals(sorted(r.json["apps"][0].keys()),
+                          ["modifiedAt", "origin"])
+        self.assertEquals(len(r.json["devices"]), 1)
+        self.assertFalse("apps" in r.json["devices"][0])
+        # With "full" we get everything.
+        r = self.app.get(self.root + "/?full=1")
+        self.assertEquals(r.json["devices"][0]["apps"], device["apps"])
+        # Each collection can have its own "after" value.
+        r = self.app.get(self.root + "/?apps_after=%d" % (ts1,))
+        self.assertEquals(len(r.json["apps"]), 0)
+        self.assertEquals(len(r.json["devices"]), 1)
+        r = self.app.get(self.root + "/?after=%d&apps_after=%d"
+                         % (ts2, ts1 - 1))
+        self.assertEquals(len(r.json["apps"]), 1)
+        self.assertEquals(len(r.json["devices"]), 0)
+        # The newest timestamp works as an ETag.
+        headers = {"If-None-Match": r.headers["ETag"]}
+        self.app.get(self.root + "/", headers=headers, status=304)
+
+    def test_getting_info_about_all_collections(self):
+        info = self.app.get(self.root + "/info").json
+        self.assertEquals(info["apps"]["count"], 0)
+        self.assertEquals(info["apps"]["bytes"], 0)
+        for i in xrange(3):
+            data = TEST_APP_DATA.copy()
+            data["origin"] = "https://example%d.com" % (i,)
+            r = self.app.put_json(self.root + "/apps/" +
+                                  origin_to_id(data["origin"]), data)
+        ts = int(r.headers["X-Last-Modified"])
+        r = self.app.get(self.root + "/info")
+        info = r.json
+        self.assertEquals(sorted(info.keys()), ["apps", "devices"])
+        self.assertEquals(info["apps"]["count"], 3)
+        self.assertEquals(info["apps"]["modified"], ts)
+        self.assertTrue(info["apps"]["bytes"] > 0)
+        self.assertEquals(info["devices"]["count"], 0)
+        self.assertEquals(r.headers["X-Last-Modified"], str(ts))
+        # Deleted apps leave tombstones, but aren't counted as items.
+        size = info["apps"]["bytes"]
+        r = self.app.delete(self.root + "/apps/" +
+                            origin_to_id(data["origin"]))
+        ts = int(r.headers["X-Last-Modified"])
+        r = self.app.get(self.root + "/info")
+        info = r.json
+        self.assertEquals(info["apps"]["count"], 2)
+        self.assertEquals(info["apps"]["modified"], ts)
+        self.assertTrue(0 < info["apps"]["bytes"] < size)
+        self.assertEquals(r.headers["X-Last-Modified"], str(ts))
+        # Re-creating a deleted app counts it again.
+        self.app.put_json(self.root + "/apps/" + origin_to_id(data["origin"]),
+                          data)
+        info = self.app.get(self.root + "/info").json
+        self.assertEquals(info["apps"]["count"], 3)
+        self.assertEquals(info["apps"]["bytes"], size)
+        # Deleting the whole collection leaves nothing counted.
+        self.app.delete(self.root + "/apps/")
+        info = self.app.get(self.root + "/info").json
+        self.assertEquals(info["apps"]["count"], 0)
+        self.assertEquals(info["apps"]["bytes"], 0)
+
     def test_listing_of_full_app_records(self):
         data1 = TEST_APP_DATA.copy()
         id1 = origin_to_id(data1["origin"])
@@ -263,6 +393,96 @@ class TestAITC(AITCFunctionalTestCase):
         #apps = self.app.get(self.root + "/apps/", headers=headers, status=200)
         #self.assertEquals(len(apps.json["apps"]), 1)
 
+    def test_listing_of_apps_with_etags(self):
+        # An empty collection has no ETag.
+        r = self.app.get(self.root + "/apps/")
+        self.assertFalse("ETag" in r.headers)
+        # "If-None-Match: *" only matches once there's something there.
+        headers = {"If-None-Match": "*"}
+        self.app.get(self.root + "/apps/", headers=headers, status=200)
+        data = TEST_APP_DATA.copy()
+        id = origin_to_id(data["origin"])
+        r = self.app.put_json(self.root + "/apps/" + id, data)
+        ts = r.headers["X-Last-Modified"]
+        self.app.get(self.root + "/apps/", headers=headers, status=304)
+        self.app.get(self.root + "/apps/" + id, headers=headers, status=304)
+        # Listings report the collection's modification time as ETag.
+        r = self.app.get(self.root + "/apps/")
+        self.assertEquals(r.headers["ETag"], '"%s"' % (ts,))
+        self.assertEquals(r.headers["X-Last-Modified"], ts)
+        etag = r.headers["ETag"]
+        # A matching If-None-Match header gives 304 Not Modified.
+        headers = {"If-None-Match": etag}
+        r = self.app.get(self.root + "/apps/", headers=headers, status=304)
+        self.assertEquals(r.headers["ETag"], etag)
+        self.app.get(self.root + "/apps/?full=1", headers=headers,
+                     status=304)
+        # A stale one gives the listing.
+        headers = {"If-None-Match": '"%d"' % (int(ts) - 1,)}
+        apps = self.app.get(self.root + "/apps/", headers=headers,
+                            status=200)
+        self.assertEquals(len(apps.json["apps"]), 1)
+        # So does an If-Modified-Since date older than the last write.
+        headers = {"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"}
+        self.app.get(self.root + "/apps/", headers=headers, status=200)
+        # But one from after the last write gives 304 Not Modified.
+        headers = {"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"}
+        self.app.get(self.root + "/apps/", headers=headers, status=304)
+
+    def test_that_invalid_after_values_give_a_400_response(self):
+        self.app.get(self.root + "/apps/?after=yesterday", status=400)
+
+    def test_paginated_listing_of_apps(self):
+        origins = []
+        for i in xrange(5):
+            data = TEST_APP_DATA.copy()
+            data["origin"] = "https://example%d.com" % (i,)
+            id = origin_to_id(data["origin"])
+            r = self.app.put_json(self.root + "/apps/" + id, data)
+            origins.append(data["origin"])
+            if i == 1:
+                ts = int(r.headers["X-Last-Modified"])
+                time.sleep(0.01)
+        # Follow the tokens through each page of the listing.
+        r = self.app.get(self.root + "/apps/?limit=2")
+        pages = [r.json["apps"]]
+        while "X-Next-Token" in r.headers:
+            token = r.headers["X-Next-Token"]
+            r = self.app.get(self.root + "/apps/?limit=2&token=" + token)
+            pages.append(r.json["apps"])
+        self.assertEquals([len(page) for page in pages], [2, 2, 1])
+        seen = [app["origin"] for page in pages for app in page]
+        self.assertEquals(sorted(seen), sorted(origins))
+        # Pagination works together with "after".
+        r = self.app.get(self.root + "/apps/?limit=2&after=" + str(ts))
+        pages = [r.json["apps"]]
+        token = r.headers["X-Next-Token"]
+        r = self.app.get(self.root + "/apps/?limit=2&token=" + token)
+        pages.append(r.json["apps"])
+        self.assertFalse("X-Next-Token" in r.headers)
+        seen = [app["origin"] for page in pages for app in page]
+        self.assertEquals(sorted(seen), sorted(origins[2:]))
+        # Apps rewritten between pages are listed again at the end, and
+        # don't make any of the others get skipped.
+        r = self.app.get(self.root + "/apps/?limit=2")
+        pages = [r.json["apps"]]
+        data = TEST_APP_DATA.copy()
+        data["origin"] = origins[0]
+        data["name"] = "Examplinator 4000"
+        self.app.put_json(self.root + "/apps/" + origin_to_id(origins[0]),
+                          data)
+        while "X-Next-Token" in r.headers:
+            token = r.headers["X-Next-Token"]
+            r = self.app.get(self.root + "/apps/?limit=2&token=" + token)
+            pages.append(r.json["apps"])
+        seen = [app["origin"] for page in pages for app in page]
+        self.assertEquals(sorted(set(seen)), sorted(origins))
+        self.assertEquals(seen[-1], origins[0])
+        # Bad values give a 400.
+        self.app.get(self.root + "/apps/?limit=0", status=400)
+        self.app.get(self.root + "/apps/?limit=2&token=XXX", status=400)
+        self.app.get(self.root + "/apps/?token=" + token, status=400)
+
     def test_getting_an_app_with_x_if_modified_since(self):
         data = TEST_APP_DATA.copy()
         id = origin_to_id(data["origin"])
@@ -286,9 +506,13 @@ class TestAITC(AITCFunctionalTestCase):
         # X-I-M-S header after time of write => 304 Not Modified
         headers = {"X-If-Modified-Since": str(ts + 1)}
         self.app.get(self.root + "/apps/" + id, headers=headers, status=304)
-        # After another write, we get the updated data.
+        # Re-writing the same data doesn't change anything.
         self.app.put_json(self.root + "/apps/" + id, data)
         headers = {"X-If-Modified-Since": str(ts + 1)}
+        self.app.get(self.root + "/apps/" + id, headers=headers, status=304)
+        # After a write that changes the app, we get the updated data.
+        data["name"] = "Examplinator 4000"
+        self.app.put_json(self.root + "/apps/" + id, data)
         app = self.app.get(self.root + "/apps/" + id, headers=headers).json
         del app["modifiedAt"]
         del app["installedAt"]
@@ -350,21 +574,206 @@ class TestAITC(AITCFunctionalTestCase):
         data["apps"] = {"data": "X" * 7 * 1024}
         self.app.put_json(self.root + "/devices/" + id, data, status=201)
 
+    def test_uploading_gzipped_items(self):
+        data = TEST_APP_DATA.copy()
+        id = origin_to_id(data["origin"])
+        headers = {"Content-Type": "application/json",
+                   "Content-Encoding": "gzip"}
+        body = gzip_compress(json.dumps(data))
+        self.app.put(self.root + "/apps/" + id, body, headers=headers,
+                     status=201)
+        app = self.app.get(self.root + "/apps/" + id).json
+        self.assertEquals(app["name"], data["name"])
+        # The size limit applies to the decompressed data.
+        data["receipts"] = ["X" * 8 * 1024]
+        body = gzip_compress(json.dumps(data))
+        self.assertTrue(len(body) < 1024)
+        self.app.put(self.root + "/apps/" + id, body, headers=headers,
+                     status=413)
+        # Broken gzip data gives a 400.
+        self.app.put(self.root + "/apps/" + id, body[:20] + "XXXX",
+                     headers=headers, status=400)
+        # Unknown encodings give a 415.
+        headers["Content-Encoding"] = "x-unknown"
+        self.app.put(self.root + "/apps/" + id, json.dumps(data),
+                     headers=headers, status=415)
+
+    def test_listing_of_apps_with_gzip_compression(self):
+        for i in xrange(10):
+            data = TEST_APP_DATA.copy()
+            data["origin"] = "https://example%d.com" % (i,)
+            id = origin_to_id(data["origin"])
+            self.app.put_json(self.root + "/apps/" + id, data)
+        r = self.app.get(self.root + "/apps/?full=1")
+        self.assertFalse("Content-Encoding" in r.headers)
+        self.assertTrue("Accept-Encoding" in r.headers.get("Vary", ""))
+        headers = {"Accept-Encoding": "gzip"}
+        r_gz = self.app.get(self.root + "/apps/?full=1", headers=headers)
+        self.assertEquals(r_gz.headers["Content-Encoding"], "gzip")
+        self.assertEquals(gzip_decompress(r_gz.body), r.body)
+        self.assertEquals(r_gz.headers["Vary"].count("Accept-Encoding"), 1)
+        # The compressed body gets its own ETag, which can still be used
+        # to check for changes.
+        etag = r.headers["ETag"]
+        self.assertEquals(r_gz.headers["ETag"], etag[:-1] + '-gzip"')
+        for tag in (etag, r_gz.headers["ETag"]):
+            headers = {"Accept-Encoding": "gzip", "If-None-Match": tag}
+            r_304 = self.app.get(self.root + "/apps/?full=1",
+                                 headers=headers, status=304)
+            self.assertTrue("Accept-Encoding" in r_304.headers["Vary"])
+        # Clients can turn it off.
+        headers = {"Accept-Encoding": "gzip;q=0"}
+        r_gz = self.app.get(self.root + "/apps/?full=1", headers=headers)
+        self.assertFalse("Content-Encoding" in r_gz.headers)
+
     def test_deleting_an_app_with_x_if_unmodified_since(self):
         data = TEST_APP_DATA.copy()
         id = origin_to_id(data["origin"])
         r = self.app.put_json(self.root + "/apps/" + id, data, status=201)
         ts = int(r.headers["X-Last-Modified"])
         time.sleep(0.01)
-        # X-I-U-S header equalt to zero => 412 Precondition Failed
-        headers = {"X-If-Unmodified-Since": "0"}
-        self.app.delete(self.root + "/apps/" + id, headers=headers, status=412)
-        # X-I-U-S header before time of write => 412 Precondition Failed
-        headers = {"X-If-Unmodified-Since": str(ts - 1)}
-        self.app.delete(self.root + "/apps/" + id, headers=headers, status=412)
-        # X-I-U-S header at time of write => delete succeeds
-        headers = {"X-If-Unmodified-Since": str(ts)}
-        self.app.delete(self.root + "/apps/" + id, headers=headers, status=204)
+        # Failed deletes mustn't wake up anyone waiting for changes.
+        notifications = self.config.registry["aitc.controller"].notifications
+        notified = []
+        notify = notifications.notify
+        notifications.notify = lambda *args: notified.append(args)
+        try:
+            # X-I-U-S header equalt to zero => 412 Precondition Failed
+            headers = {"X-If-Unmodified-Since": "0"}
+            self.app.delete(self.root + "/apps/" + id, headers=headers,
+                            status=412)
+            # X-I-U-S header before time of write => 412 Precondition Failed
+            headers = {"X-If-Unmodified-Since": str(ts - 1)}
+            self.app.delete(self.root + "/apps/" + id, headers=headers,
+                            status=412)
+            self.app.delete(self.root + "/apps/NONEXISTENT", status=404)
+            self.assertEquals(notified, [])
+            r = self.app.get(self.root + "/apps/")
+            self.assertEquals(r.headers["X-Last-Modified"], str(ts))
+            # X-I-U-S header at time of write => delete succeeds
+            headers = {"X-If-Unmodified-Since": str(ts)}
+            self.app.delete(self.root + "/apps/" + id, headers=headers,
+                            status=204)
+            self.assertEquals(len(notified), 1)
+        finally:
+            notifications.notify = notify
+
+    def test_getting_an_app_with_etags(self):
+        data = TEST_APP_DATA.copy()
+        id = origin_to_id(data["origin"])
+        r = self.app.put_json(self.root + "/apps/" + id, data)
+        etag = r.headers["ETag"]
+        self.assertEquals(etag, '"%s"' % (r.headers["X-Last-Modified"],))
+        # Each item reports its own ETag.
+        r = self.app.get(self.root + "/apps/" + id)
+        self.assertEquals(r.headers["ETag"], etag)
+        # A matching If-None-Match header gives 304 Not Modified.
+        headers = {"If-None-Match": etag}
+        r = self.app.get(self.root + "/apps/" + id, headers=headers,
+                         status=304)
+        self.assertEquals(r.headers["ETag"], etag)
+        # After a change to the item, we get the new data and ETag.
+        time.sleep(0.01)
+        data["name"] = "Examplinator 4000"
+        self.app.put_json(self.root + "/apps/" + id, data)
+        r = self.app.get(self.root + "/apps/" + id, headers=headers)
+        self.assertEquals(r.json["name"], data["name"])
+        self.assertNotEquals(r.headers["ETag"], etag)
+
+    def test_putting_an_app_with_if_match(self):
+        data = TEST_APP_DATA.copy()
+        id = origin_to_id(data["origin"])
+        # If-Match on a nonexistent item => 412 Precondition Failed
+        headers = {"If-Match": "*"}
+        self.app.put_json(self.root + "/apps/" + id, data, headers=headers,
+                          status=412)
+        r = self.app.put_json(self.root + "/apps/" + id, data, status=201)
+        etag = r.headers["ETag"]
+        time.sleep(0.01)
+        # If-Match with the current ETag => update succeeds
+        data["name"] = "Examplinator 4000"
+        headers = {"If-Match": etag}
+        r = self.app.put_json(self.root + "/apps/" + id, data,
+                              headers=headers, status=204)
+        self.assertNotEquals(r.headers["ETag"], etag)
+        # If-Match with the old ETag => 412 Precondition Failed
+        data["name"] = "Examplinator 5000"
+        self.app.put_json(self.root + "/apps/" + id, data, headers=headers,
+                          status=412)
+        app = self.app.get(self.root + "/apps/" + id).json
+        self.assertEquals(app["name"], "Examplinator 4000")
+        # If-Match: * on an existing item => update succeeds
+        headers = {"If-Match": "*"}
+        self.app.put_json(self.root + "/apps/" + id, data, headers=headers,
+                          status=204)
+
+    def test_deleting_an_app_with_if_match(self):
+        data = TEST_APP_DATA.copy()
+        id = origin_to_id(data["origin"])
+        r = self.app.put_json(self.root + "/apps/" + id, data, status=201)
+        etag = r.headers["ETag"]
+        # If-Match with some other ETag => 412 Precondition Failed
+        headers = {"If-Match": '"%d"' % (int(etag.strip('"')) - 1,)}
+        self.app.delete(self.root + "/apps/" + id, headers=headers,
+                        status=412)
+        self.app.get(self.root + "/apps/" + id, status=200)
+        # If-Match with the current ETag => delete succeeds
+        headers = {"If-Match": etag}
+        self.app.delete(self.root + "/apps/" + id, headers=headers,
+                        status=204)
+        self.app.get(self.root + "/apps/" + id, status=404)
+
+    def test_that_deleted_apps_are_listed_when_fetching_changes(self):
+        data = TEST_APP_DATA.copy()
+        id = origin_to_id(data["origin"])
+        r = self.app.put_json(self.root + "/apps/" + id, data)
+        ts1 = int(r.headers["X-Last-Modified"])
+        time.sleep(0.01)
+        r = self.app.delete(self.root + "/apps/" + id)
+        ts2 = int(r.headers["X-Last-Modified"])
+        self.assertTrue(ts2 > ts1)
+        self.app.get(self.root + "/apps/" + id, status=404)
+        # Complete listings don't include deleted apps.
+        apps = self.app.get(self.root + "/apps/").json["apps"]
+        self.assertEquals(apps, [])
+        # But listings of changes do, so clients can find out about them.
+        r = self.app.get(self.root + "/apps/?after=" + str(ts1))
+        self.assertEquals(r.headers["X-Last-Modified"], str(ts2))
+        apps = r.json["apps"]
+        self.assertEquals(len(apps), 1)
+        self.assertEquals(apps[0]["origin"], data["origin"])
+        self.assertEquals(apps[0]["deleted"], True)
+        self.assertTrue(isinstance(apps[0]["deletedAt"], (int, long)))
+        self.assertEquals(apps[0]["modifiedAt"], apps[0]["deletedAt"])
+        apps = self.app.get(self.root + "/apps/?full=1&after=" + str(ts1))
+        self.assertEquals(apps.json["apps"][0]["deleted"], True)
+        # Deleting it again gives a 404.
+        self.app.delete(self.root + "/apps/" + id, status=404)
+        # Putting it back re-creates it.
+        self.app.put_json(self.root + "/apps/" + id, data, status=201)
+        apps = self.app.get(self.root + "/apps/?after=" + str(ts1))
+        self.assertFalse("deleted" in apps.json["apps"][0])
+
+    def test_that_changes_from_before_the_after_horizon_are_gone(self):
+        old = int((time.time() - 31 * 86400) * 1000)
+        # By default, changes since any time can be listed.
+        self.app.get(self.root + "/apps/?after=%d" % (old,), status=200)
+        self.app.get(self.root + "/?after=%d" % (old,), status=200)
+        controller = self.config.registry["aitc.controller"]
+        controller.after_horizon = 30 * 86400
+        try:
+            # Changes from before the horizon may have been purged, so
+            # asking for them says that a complete listing is needed.
+            self.app.get(self.root + "/apps/?after=%d" % (old,), status=410)
+            self.app.get(self.root + "/?after=%d" % (old,), status=410)
+            self.app.get(self.root + "/?apps_after=%d" % (old,), status=410)
+            # Asking for everything is always fine.
+            self.app.get(self.root + "/apps/?after=0", status=200)
+            self.app.get(self.root + "/?after=0", status=200)
+            recent = int((time.time() - 86400) * 1000)
+            self.app.get(self.root + "/apps/?after=%d" % (recent,))
+        finally:
+            controller.after_horizon = 0
 
     def test_that_getting_a_nonexistant_app_gives_a_404_response(self):
         self.app.get(self.root + "/apps/NONEXISTENT", status=404)
@@ -392,6 +801,121 @@ class TestAITC(AITCFunctionalTestCase):
         data.pop("manifestPath")
         self.app.put_json(self.root + "/apps/" + id, data, status=400)
 
+    def test_uploading_a_batch_of_apps(self):
+        # Write one app beforehand, to check its installedAt is kept.
+        data = TEST_APP_DATA.copy()
+        id = origin_to_id(data["origin"])
+        self.app.put_json(self.root + "/apps/" + id, data)
+        app1 = self.app.get(self.root + "/apps/" + id).json
+        time.sleep(0.01)
+        batch = []
+        for i in xrange(3):
+            data = TEST_APP_DATA.copy()
+            if i:
+                data["origin"] = "https://example%d.com" % (i,)
+            else:
+                # Change the existing app, so that it is really written.
+                data["name"] = "Examplinator 4000"
+            batch.append(data)
+        bad_data = TEST_APP_DATA.copy()
+        bad_data["origin"] = "https://broken.com"
+        del bad_data["manifestPath"]
+        batch.append(bad_data)
+        batch.append(["NOT", "AN", "OBJECT"])
+        big_data = TEST_APP_DATA.copy()
+        big_data["origin"] = "https://big.com"
+        big_data["receipts"] = ["X" * 8 * 1024]
+        batch.append(big_data)
+        r = self.app.post_json(self.root + "/apps/", batch)
+        self.assertTrue("X-Last-Modified" in r.headers)
+        ids = [origin_to_id(data["origin"]) for data in batch[:3]]
+        self.assertEquals(r.json["success"], ids)
+        self.assertEquals(sorted(r.json["failed"].keys()),
+                          sorted(["3", "4", origin_to_id("https://big.com")]))
+        # All of the good apps were written, with the same timestamp.
+        apps = self.app.get(self.root + "/apps/?full=1").json["apps"]
+        self.assertEquals(len(apps), 3)
+        ts = apps[0]["modifiedAt"]
+        self.assertGreater(ts, app1["modifiedAt"])
+        for app in apps:
+            self.assertEquals(app["modifiedAt"], ts)
+            if app["origin"] == app1["origin"]:
+                self.assertEquals(app["installedAt"], app1["installedAt"])
+            else:
+                self.assertEquals(app["installedAt"], ts)
+
+    def test_that_batch_items_are_measured_without_whitespace(self):
+        # Pad an app out to exactly the item size limit, as compact JSON.
+        data = TEST_APP_DATA.copy()
+        data["receipts"] = [""]
+        size = len(json.dumps(data, separators=(",", ":")))
+        data["receipts"] = ["X" * (MAX_ITEM_SIZE - size)]
+        self.assertEquals(len(json.dumps(data, separators=(",", ":"))),
+                          MAX_ITEM_SIZE)
+        self.assertTrue(len(json.dumps(data)) > MAX_ITEM_SIZE)
+        r = self.app.post_json(self.root + "/apps/", [data])
+        self.assertEquals(r.json["success"], [origin_to_id(data["origin"])])
+        self.assertEquals(r.json["failed"], {})
+        # One byte more is too much.
+        data["receipts"][0] += "X"
+        r = self.app.post_json(self.root + "/apps/", [data])
+        self.assertEquals(r.json["success"], [])
+        self.assertEquals(r.json["failed"].keys(),
+                          [origin_to_id(data["origin"])])
+
+    def test_that_batch_uploads_are_limited_in_size(self):
+        batch = []
+        for i in xrange(101):
+            data = TEST_DEVICE_DATA.copy()
+            data["uuid"] = data["uuid"][:-3] + "%03d" % (i,)
+            batch.append(data)
+        self.app.post_json(self.root + "/devices/", batch, status=413)
+        r = self.app.post_json(self.root + "/devices/", batch[:100])
+        self.assertEquals(len(r.json["success"]), 100)
+        self.app.post_json(self.root + "/devices/", {"not": "a list"},
+                           status=400)
+        self.app.post_json(self.root + "/oops/", batch[:1], status=404)
+
+    def test_deleting_several_apps_at_once(self):
+        batch = []
+        for i in xrange(4):
+            data = TEST_APP_DATA.copy()
+            data["origin"] = "https://example%d.com" % (i,)
+            batch.append(data)
+        ids = self.app.post_json(self.root + "/apps/", batch).json["success"]
+        # Delete some of them by id.
+        r = self.app.delete(self.root + "/apps/?ids=" + ",".join(ids[:2]),
+                            status=204)
+        ts = r.headers["X-Last-Modified"]
+        r = self.app.get(self.root + "/apps/")
+        self.assertEquals(r.headers["X-Last-Modified"], ts)
+        apps = r.json["apps"]
+        self.assertEquals(sorted(app["origin"] for app in apps),
+                          ["https://example2.com", "https://example3.com"])
+        self.app.delete(self.root + "/apps/?ids=bad!id", status=400)
+        # Delete the rest by deleting the collection.
+        self.app.delete(self.root + "/apps/", status=204)
+        apps = self.app.get(self.root + "/apps/").json["apps"]
+        self.assertEquals(apps, [])
+        # Deleting it again is harmless, and changes nothing.
+        r = self.app.get(self.root + "/apps/")
+        ts = r.headers["X-Last-Modified"]
+        r = self.app.delete(self.root + "/apps/", status=204)
+        self.assertEquals(r.headers["X-Last-Modified"], ts)
+        self.app.delete(self.root + "/oops/", status=404)
+
+    def test_deleting_all_data_for_a_user(self):
+        data = TEST_APP_DATA.copy()
+        self.app.put_json(self.root + "/apps/" + origin_to_id(data["origin"]),
+                          data)
+        data = TEST_DEVICE_DATA.copy()
+        self.app.put_json(self.root + "/devices/" + data["uuid"], data)
+        self.app.delete(self.root + "/", status=204)
+        apps = self.app.get(self.root + "/apps/").json["apps"]
+        self.assertEquals(apps, [])
+        devices = self.app.get(self.root + "/devices/").json["devices"]
+        self.assertEquals(devices, [])
+
     def test_that_uploads_to_unknown_collection_give_a_404_response(self):
         data = TEST_APP_DATA.copy()
         id = origin_to_id(data["origin"])
@@ -426,6 +950,56 @@ class TestAITCMemcached(TestAITC):
         super(TestAITCMemcached, self)._cleanup_test_databases()
 
 
+class TestAITCStreaming(TestAITC):
+    """AITC testcases run with streaming of collection listings enabled."""
+
+    @restore_env("MOZSVC_TEST_INI_FILE")
+    def setUp(self):
+        # Force use of the streaming-specific config file.  It uses a tiny
+        # page size, so that listings are streamed in several pages.
+        os.environ["MOZSVC_TEST_INI_FILE"] = "tests-streaming.ini"
+        super(TestAITCStreaming, self).setUp()
+
+    def test_that_streamed_listings_match_buffered_ones(self):
+        for i in xrange(5):
+            data = TEST_APP_DATA.copy()
+            data["origin"] = "https://example%d.com" % (i,)
+            r = self.app.put_json(self.root + "/apps/" +
+                                  origin_to_id(data["origin"]), data)
+            if i == 0:
+                ts = int(r.headers["X-Last-Modified"])
+                time.sleep(0.01)
+        # Delete the first app, so it shows up as a change after "ts".
+        self.app.delete(self.root + "/apps/" +
+                        origin_to_id("https://example0.com"))
+        controller = self.config.registry["aitc.controller"]
+        for query in ("", "?full=1", "?after=%d" % (ts,),
+                      "?full=1&after=%d" % (ts,)):
+            for headers in ({}, {"Accept-Encoding": "gzip"}):
+                bodies = []
+                for stream_listings in (True, False):
+                    controller.stream_listings = stream_listings
+                    r = self.app.get(self.root + "/apps/" + query,
+                                     headers=headers)
+                    body = r.body
+                    if "gzip" in headers.values():
+                        self.assertEquals(r.headers["Content-Encoding"],
+                                          "gzip")
+                        body = gzip_decompress(body)
+                    bodies.append(json.loads(body)["apps"])
+                controller.stream_listings = True
+                streamed, buffered = [sorted(apps) for apps in bodies]
+                self.assertEquals(streamed, buffered)
+                # Deleted apps are only listed when fetching changes.
+                deleted = [app for app in streamed if app.get("deleted")]
+                if "after" in query:
+                    self.assertEquals(len(streamed), 5)
+                    self.assertEquals(len(deleted), 1)
+                else:
+                    self.assertEquals(len(streamed), 4)
+                    self.assertEquals(deleted, [])
+
+
 if __name__ == "__main__":
     # When run as a script, this file will execute the
     # functional tests against a live webserver.
@@ -0,0 +1,74 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+import unittest2
+
+from aitc.cache import TimestampCache, ListingCache, MISSING
+
+
+class TestTimestampCache(unittest2.TestCase):
+
+    def test_getting_and_setting_timestamps(self):
+        cache = TimestampCache(10, 60)
+        self.assertEquals(cache.get(1, "apps"), MISSING)
+        cache.set(1, "apps", 42)
+        cache.set(1, "devices", None)
+        self.assertEquals(cache.get(1, "apps"), 42)
+        self.assertEquals(cache.get(1, "devices"), None)
+        self.assertEquals(cache.get(2, "apps"), MISSING)
+        cache.invalidate(1, "apps")
+        self.assertEquals(cache.get(1, "apps"), MISSING)
+
+    def test_that_advancing_never_moves_timestamps_backwards(self):
+        cache = TimestampCache(10, 60)
+        cache.advance(1, "apps", None)
+        self.assertEquals(cache.get(1, "apps"), None)
+        cache.advance(1, "apps", 42)
+        self.assertEquals(cache.get(1, "apps"), 42)
+        # A write or lookup that finishes late can't roll the value back.
+        cache.advance(1, "apps", 41)
+        cache.advance(1, "apps", None)
+        self.assertEquals(cache.get(1, "apps"), 42)
+        cache.advance(1, "apps", 43)
+        self.assertEquals(cache.get(1, "apps"), 43)
+        cache.invalidate(1, "apps")
+        cache.advance(1, "apps", 40)
+        self.assertEquals(cache.get(1, "apps"), 40)
+
+    def test_that_the_cache_is_bounded_in_size(self):
+        cache = TimestampCache(10, 60)
+        for userid in xrange(20):
+            cache.set(userid, "apps", userid)
+        found = [userid for userid in xrange(20)
+                 if cache.get(userid, "apps") is not MISSING]
+        self.assertEquals(len(found), 10)
+        self.assertTrue(19 in found)
+
+    def test_that_cache_entries_expire(self):
+        cache = TimestampCache(10, 0.01)
+        cache.set(1, "apps", 42)
+        self.assertEquals(cache.get(1, "apps"), 42)
+        time.sleep(0.02)
+        self.assertEquals(cache.get(1, "apps"), MISSING)
+
+
+class TestListingCache(unittest2.TestCase):
+
+    def setUp(self):
+        # Skip the tests if memcached isn't available.
+        try:
+            self.cache = ListingCache(["127.0.0.1:11211"], prefix="aitc-test")
+            self.cache._client.flush_all()
+        except Exception:
+            raise unittest2.SkipTest()
+
+    def test_getting_and_setting_listings(self):
+        self.assertEquals(self.cache.get(1, "apps", 42, "full"), None)
+        self.cache.set(1, "apps", 42, "full", '{"apps": []}')
+        self.assertEquals(self.cache.get(1, "apps", 42, "full"),
+                          '{"apps": []}')
+        # Other variants and timestamps are not found.
+        self.assertEquals(self.cache.get(1, "apps", 42, "abbrev"), None)
+        self.assertEquals(self.cache.get(1, "apps", 43, "full"), None)
+        self.assertEquals(self.cache.get(2, "apps", 42, "full"), None)
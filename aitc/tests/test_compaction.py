@@ -0,0 +1,43 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+
+from syncstorage.storage import NotFoundError
+
+from aitc.records import AppRecord
+from aitc.storage import upsert_record, delete_record
+from aitc.compaction import TombstoneCompactor
+from aitc.tests.support import AITCTestCase
+from aitc.tests.test_storage import TEST_APP_DATA
+
+
+class TestTombstoneCompactor(AITCTestCase):
+
+    def setUp(self):
+        super(TestTombstoneCompactor, self).setUp()
+        self.storage = self.config.registry["syncstorage:storage:default"]
+        self.app = AppRecord(TEST_APP_DATA)
+        upsert_record(self.storage, 1, "apps", self.app.get_id(), self.app)
+        delete_record(self.storage, 1, "apps", self.app.get_id(),
+                      AppRecord, 42)
+
+    def test_that_tombstones_are_kept_until_the_horizon(self):
+        compactor = TombstoneCompactor(horizon=3600)
+        self.assertEquals(compactor.compact(self.storage, 1, "apps"), 0)
+        self.storage.get_item(1, "apps", self.app.get_id())
+
+    def test_that_tombstones_are_purged_in_the_background(self):
+        compactor = TombstoneCompactor(horizon=-1)
+        compactor.schedule(self.storage, 1, "apps")
+        for _ in xrange(500):
+            try:
+                self.storage.get_item(1, "apps", self.app.get_id())
+            except NotFoundError:
+                break
+            time.sleep(0.01)
+        else:
+            self.fail("tombstone was not purged")
+        # Collections are only compacted once per interval.
+        compactor.schedule(self.storage, 1, "apps")
+        self.assertTrue(compactor._queue.empty())
@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+import threading
+import unittest
+
+from aitc.concurrency import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def _run_concurrently(self, flight, key, func, num=5):
+        """Make several concurrent calls, while func blocks on an event."""
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                       self._call_and_catch(flight, key, func)))
+                   for _ in xrange(num)]
+        # Start the leader, then the followers once it's in progress.
+        threads[0].start()
+        while key not in flight._calls:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        # Give the followers a chance to start waiting.
+        time.sleep(0.1)
+        return threads, results
+
+    def _call_and_catch(self, flight, key, func):
+        try:
+            return flight.call(key, func)
+        except Exception, e:
+            return e
+
+    def test_that_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            release.wait()
+            return "RESULT"
+
+        threads, results = self._run_concurrently(flight, "key", func)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(sorted(results), [("RESULT", False)] +
+                                           [("RESULT", True)] * 4)
+        # Later calls run the function again.
+        self.assertEquals(flight.call("key", func), ("RESULT", False))
+        self.assertEquals(len(calls), 2)
+
+    def test_that_errors_are_shared_too(self):
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def func():
+            release.wait()
+            raise ValueError("OOPS")
+
+        threads, results = self._run_concurrently(flight, "key", func)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(results), 5)
+        for result in results:
+            self.assertTrue(isinstance(result, ValueError))
+
+    def test_that_different_keys_are_not_coalesced(self):
+        flight = SingleFlight()
+        self.assertEquals(flight.call("one", lambda: 1), (1, False))
+        self.assertEquals(flight.call("two", lambda: 2), (2, False))
@@ -0,0 +1,47 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import StringIO
+
+from webob import Request
+from pyramid.httpexceptions import HTTPRequestEntityTooLarge
+
+from aitc.tests.support import AITCTestCase
+
+
+class UnreadableInput(object):
+    """A wsgi.input that fails the test if anything tries to read it."""
+
+    def read(self, size=-1):
+        raise AssertionError("the request body should not be read")
+
+    readline = read
+
+
+class TestAITCController(AITCTestCase):
+
+    def setUp(self):
+        super(TestAITCController, self).setUp()
+        self.controller = self.config.registry["aitc.controller"]
+
+    def test_that_oversized_bodies_are_rejected_without_reading(self):
+        request = Request.blank("/", method="PUT")
+        request.environ["wsgi.input"] = UnreadableInput()
+        request.environ["CONTENT_LENGTH"] = str(100 * 1024 * 1024)
+        self.assertRaises(HTTPRequestEntityTooLarge,
+                          self.controller._get_request_body, request, 1024)
+
+    def test_that_body_reads_are_bounded(self):
+        # Chunked uploads have no Content-Length to check up front.
+        request = Request.blank("/", method="PUT")
+        request.environ["wsgi.input"] = StringIO.StringIO("X" * 4096)
+        request.environ["webob.is_body_readable"] = True
+        self.assertEquals(request.content_length, None)
+        self.assertRaises(HTTPRequestEntityTooLarge,
+                          self.controller._get_request_body, request, 1024)
+        self.assertEquals(request.environ["wsgi.input"].tell(), 1025)
+        request = Request.blank("/", method="PUT")
+        request.environ["wsgi.input"] = StringIO.StringIO("X" * 1024)
+        request.environ["CONTENT_LENGTH"] = "1024"
+        body = self.controller._get_request_body(request, 1024)
+        self.assertEquals(body, "X" * 1024)
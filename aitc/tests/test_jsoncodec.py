@@ -0,0 +1,49 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import unittest
+
+from aitc.jsoncodec import get_codec, get_available_codecs, JSONRenderer
+
+
+TEST_DATA = {
+    "origin": "https://example.com",
+    "name": u"Examplinator \u2603\nwith a newline",
+    "installedAt": 1330535996745,
+    "receipts": ["receipt1", "receipt2"],
+    "apps": {"foo": "bar", "position": 1.0 / 3},
+    "hidden": True,
+}
+
+
+class TestJSONCodecs(unittest.TestCase):
+
+    def test_that_all_available_codecs_round_trip_data(self):
+        codecs = get_available_codecs()
+        self.assertTrue("simplejson" in [codec.name for codec in codecs])
+        for codec in codecs:
+            body = codec.dumps(TEST_DATA)
+            # Stored payloads rely on there being no raw newlines.
+            self.assertFalse("\n" in body)
+            data = codec.loads(body)
+            if codec.lossless:
+                self.assertEquals(data, TEST_DATA)
+            else:
+                position = data["apps"].pop("position")
+                self.assertAlmostEquals(position, 1.0 / 3)
+                self.assertEquals(data["apps"], {"foo": "bar"})
+            self.assertRaises(ValueError, codec.loads, "NOT JSON")
+
+    def test_selecting_codecs_by_name(self):
+        self.assertEquals(get_codec("simplejson").name, "simplejson")
+        self.assertEquals(get_codec().name, "simplejson")
+        # Picking automatically never gives a lossy codec.
+        codec = get_codec("auto")
+        self.assertTrue(codec.lossless)
+        self.assertEquals(codec.loads(codec.dumps(TEST_DATA)), TEST_DATA)
+        self.assertRaises(ValueError, get_codec, "nonexistent")
+
+    def test_rendering_with_a_codec(self):
+        codec = get_codec("simplejson")
+        render = JSONRenderer(codec)(None)
+        self.assertEquals(codec.loads(render(TEST_DATA, {})), TEST_DATA)
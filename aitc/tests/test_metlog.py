@@ -23,7 +23,7 @@ class TestMetlog(AITCTestCase):
 
     def test_service_view_wrappers(self):
         req = self.make_request(environ={"HTTP_HOST": "localhost"})
-        req.matchdict = {'collection': 'foo'}
+        req.matchdict = {'collection': 'apps'}
         get_collection(req)
         # The two most recent msgs should be from processing that request.
         # There may be more messages due to e.g. warnings at startup.
@@ -37,3 +37,16 @@ class TestMetlog(AITCTestCase):
         self.assertEqual(counter_msg['type'], 'counter')
         self.assertEqual(counter_msg['fields']['name'],
                          'aitc.views.get_collection')
+
+    def test_timestamp_cache_counters(self):
+        msgs = self.metlog.sender.msgs
+        for i in xrange(2):
+            req = self.make_request(environ={"HTTP_HOST": "localhost"})
+            req.matchdict = {'collection': 'apps'}
+            get_collection(req)
+        counters = [json.loads(msg).get('fields', {}).get('name', '')
+                    for msg in msgs]
+        counters = [name for name in counters
+                    if name.startswith('aitc.timestamp_cache.')]
+        self.assertEqual(counters[-2:], ['aitc.timestamp_cache.miss',
+                                         'aitc.timestamp_cache.hit'])
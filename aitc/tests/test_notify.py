@@ -0,0 +1,59 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import threading
+import unittest
+
+from aitc.notify import NotificationHub
+
+
+class LoopbackBus(object):
+    """Bus that delivers each message straight back to all subscribers."""
+
+    def __init__(self):
+        self.published = []
+        self.callbacks = []
+
+    def publish(self, userid, collection):
+        self.published.append((userid, collection))
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def deliver(self, userid, collection):
+        for callback in self.callbacks:
+            callback(userid, collection)
+
+
+class TestNotificationHub(unittest.TestCase):
+
+    def test_that_watchers_are_woken_by_notifications(self):
+        hub = NotificationHub()
+        with hub.watch(1, "apps") as changed:
+            hub.notify(1, "devices")
+            hub.notify(2, "apps")
+            self.assertFalse(changed.is_set())
+            timer = threading.Timer(0.01, hub.notify, (1, "apps"))
+            timer.start()
+            changed.wait(5)
+            self.assertTrue(changed.is_set())
+            timer.join()
+        self.assertEquals(hub._waiters, {})
+
+    def test_that_notifications_before_waiting_are_not_lost(self):
+        hub = NotificationHub()
+        with hub.watch(1, "apps") as changed:
+            hub.notify(1, "apps")
+            changed.wait(5)
+            self.assertTrue(changed.is_set())
+
+    def test_that_notifications_pass_through_the_bus(self):
+        bus = LoopbackBus()
+        hub = NotificationHub(bus)
+        with hub.watch(1, "apps") as changed:
+            hub.notify(1, "apps")
+            self.assertEquals(bus.published, [(1, "apps")])
+            changed.clear()
+            # Messages from other processes come in with string userids.
+            bus.deliver("1", "apps")
+            self.assertTrue(changed.is_set())
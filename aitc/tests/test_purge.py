@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from syncstorage.storage import NotFoundError
+
+from aitc.records import AppRecord
+from aitc.storage import upsert_record, delete_record
+from aitc.purge import (RateLimiter,
+                        read_checkpoint,
+                        write_checkpoint,
+                        purge_user)
+from aitc.tests.support import AITCTestCase
+from aitc.tests.test_storage import TEST_APP_DATA
+
+
+COLLECTIONS = set(["apps", "devices"])
+
+
+class CountingLimiter(object):
+    """Stand-in for a RateLimiter that counts how often it's waited on."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def wait(self):
+        self.calls += 1
+
+
+class TestPurgeHelpers(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_reading_and_writing_checkpoints(self):
+        path = os.path.join(self.tempdir, "checkpoint")
+        self.assertEquals(read_checkpoint(path), None)
+        write_checkpoint(path, 42)
+        self.assertEquals(read_checkpoint(path), 42)
+        write_checkpoint(path, 43)
+        self.assertEquals(read_checkpoint(path), 43)
+        self.assertEquals(os.listdir(self.tempdir), ["checkpoint"])
+
+    def test_rate_limiting(self):
+        limiter = RateLimiter(100)
+        start = time.time()
+        for _ in xrange(11):
+            limiter.wait()
+        self.assertTrue(time.time() - start >= 0.09)
+        limiter = RateLimiter(0)
+        start = time.time()
+        for _ in xrange(1000):
+            limiter.wait()
+        self.assertTrue(time.time() - start < 0.1)
+
+
+class TestPurgeUser(AITCTestCase):
+
+    def setUp(self):
+        super(TestPurgeUser, self).setUp()
+        self.storage = self.config.registry["syncstorage:storage:default"]
+
+    def _make_tombstones(self, userid, num):
+        ids = []
+        for i in xrange(num):
+            app = AppRecord(TEST_APP_DATA)
+            app["origin"] = "https://example%d.com" % (i,)
+            upsert_record(self.storage, userid, "apps", app.get_id(), app)
+            delete_record(self.storage, userid, "apps", app.get_id(),
+                          AppRecord, 42)
+            ids.append(app.get_id())
+        return ids
+
+    def test_purging_tombstones_in_batches(self):
+        ids = self._make_tombstones(1, 5)
+        app = AppRecord(TEST_APP_DATA)
+        upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        before = int(time.time() * 1000) + 1000
+        # Tombstones newer than the horizon are kept.
+        self.assertEquals(purge_user(self.storage, 1, COLLECTIONS, 0),
+                          (0, False))
+        res = purge_user(self.storage, 1, COLLECTIONS, before, batch_size=2)
+        self.assertEquals(res, (5, False))
+        for item_id in ids:
+            self.assertRaises(NotFoundError, self.storage.get_item, 1,
+                              "apps", item_id)
+        self.storage.get_item(1, "apps", app.get_id())
+        # Users with no data are skipped.
+        self.assertEquals(purge_user(self.storage, 2, COLLECTIONS, before),
+                          (0, False))
+
+    def test_deleting_inactive_users(self):
+        ids = self._make_tombstones(1, 2)
+        for i in xrange(3):
+            app = AppRecord(TEST_APP_DATA)
+            app["origin"] = "https://live%d.com" % (i,)
+            upsert_record(self.storage, 1, "apps", app.get_id(), app)
+            ids.append(app.get_id())
+        # Collections that AITC doesn't use are left alone.
+        self.storage.set_item(1, "other", "item", {"payload": "data"})
+        now = int(time.time() * 1000)
+        res = purge_user(self.storage, 1, COLLECTIONS, 0,
+                         inactive_before=now - 1000)
+        self.assertEquals(res, (0, False))
+        limiter = CountingLimiter()
+        res = purge_user(self.storage, 1, COLLECTIONS, 0,
+                         inactive_before=now + 1000, batch_size=2,
+                         limiter=limiter)
+        self.assertEquals(res, (0, True))
+        for item_id in ids:
+            self.assertRaises(NotFoundError, self.storage.get_item, 1,
+                              "apps", item_id)
+        self.storage.get_item(1, "other", "item")
+        # One wait to check the user's timestamps, one to find the apps,
+        # then one for each of the three batches they're deleted in.
+        self.assertEquals(limiter.calls, 5)
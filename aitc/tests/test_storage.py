@@ -0,0 +1,448 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+import unittest
+
+import simplejson as json
+
+from syncstorage.storage import NotFoundError
+
+from aitc.records import AppRecord, DeviceRecord
+from aitc.storage import (encode_payload,
+                          split_payload,
+                          get_payload_hash,
+                          upsert_record,
+                          upsert_records,
+                          delete_record,
+                          delete_records,
+                          purge_tombstones,
+                          get_tombstone_stats,
+                          backfill_payloads,
+                          iter_userids,
+                          is_tombstone,
+                          get_item_page,
+                          iter_item_pages,
+                          find_missing_indexes,
+                          create_missing_indexes,
+                          MODIFIED_INDEX_COLUMNS,
+                          OverQuotaError,
+                          LockNotSupportedError)
+from aitc.controller import (render_json_list,
+                             render_json_lists,
+                             iter_json_list)
+from aitc.tests.support import AITCTestCase
+
+
+TEST_APP_DATA = {
+    "origin": "https://example.com",
+    "manifestPath": "/manifest.webapp",
+    "installOrigin": "https://marketplace.mozilla.org",
+    "installedAt": 1330535996745,
+    "modifiedAt": 1330535996945,
+    "name": "Examplinator\nwith a newline",
+    "receipts": ["receipt1", "receipt2"],
+}
+
+TEST_DEVICE_DATA = {
+    "uuid": "75B538D8-67AF-44E8-86A0-B1A07BE137C8",
+    "name": "Anant's Mac Pro",
+    "type": "mobile",
+    "layout": "android/phone",
+    "addedAt": 1330535996745,
+    "modifiedAt": 1330535996945,
+    "apps": {"foo": "bar"},
+}
+
+
+class UnlockableStorage(object):
+    """Wrapper around a storage backend that hides its write locks."""
+
+    def __init__(self, storage):
+        self._storage = storage
+
+    def __getattr__(self, name):
+        if name == "lock_for_write":
+            raise AttributeError(name)
+        return getattr(self._storage, name)
+
+
+class TestPayloadHandling(unittest.TestCase):
+
+    def test_that_payloads_split_into_full_and_abbreviated_forms(self):
+        for record in (AppRecord(TEST_APP_DATA),
+                       DeviceRecord(TEST_DEVICE_DATA)):
+            full, abbrev = split_payload(encode_payload(record))
+            self.assertEquals(json.loads(full), record.to_dict())
+            self.assertEquals(json.loads(abbrev), record.abbreviate())
+
+    def test_that_legacy_payloads_have_no_abbreviated_form(self):
+        payload = json.dumps(TEST_APP_DATA)
+        full, abbrev = split_payload(payload)
+        self.assertEquals(full, payload)
+        self.assertEquals(abbrev, None)
+        self.assertEquals(get_payload_hash(payload), None)
+
+    def test_that_content_hashes_ignore_timestamps(self):
+        app = AppRecord(TEST_APP_DATA)
+        hash = get_payload_hash(encode_payload(app))
+        self.assertEquals(hash, app.content_hash())
+        app["installedAt"] = app["modifiedAt"] = 42
+        self.assertEquals(app.content_hash(), hash)
+        app["name"] = "Changed"
+        self.assertNotEquals(app.content_hash(), hash)
+
+    def test_rendering_of_pre_encoded_items(self):
+        items = [json.dumps(TEST_APP_DATA), json.dumps(TEST_DEVICE_DATA)]
+        body = render_json_list("things", items)
+        self.assertTrue(isinstance(body, str))
+        self.assertEquals(json.loads(body),
+                          {"things": [TEST_APP_DATA, TEST_DEVICE_DATA]})
+        body = render_json_list("things", [])
+        self.assertEquals(json.loads(body), {"things": []})
+
+    def test_rendering_of_several_lists_of_items(self):
+        apps = [json.dumps(TEST_APP_DATA)]
+        devices = [json.dumps(TEST_DEVICE_DATA)]
+        body = render_json_lists([("apps", apps), ("devices", devices)])
+        self.assertEquals(json.loads(body), {"apps": [TEST_APP_DATA],
+                                             "devices": [TEST_DEVICE_DATA]})
+        body = render_json_lists([("apps", []), ("devices", devices)])
+        self.assertEquals(json.loads(body), {"apps": [],
+                                             "devices": [TEST_DEVICE_DATA]})
+
+    def test_streaming_of_pre_encoded_items(self):
+        items = [json.dumps(TEST_APP_DATA), json.dumps(TEST_DEVICE_DATA)]
+        for pages in ([], [[]], [items], [[], items[:1], [], items[1:], []]):
+            body = "".join(iter_json_list("things", pages))
+            self.assertEquals(body, render_json_list("things", sum(pages, [])))
+
+
+class TestStorageOperations(AITCTestCase):
+
+    def setUp(self):
+        super(TestStorageOperations, self).setUp()
+        self.storage = self.config.registry["syncstorage:storage:default"]
+
+    def _get_stored_item(self, collection, item_id):
+        bso = self.storage.get_item(1, collection, item_id)
+        return json.loads(split_payload(bso["payload"])[0])
+
+    def test_that_upsert_keeps_the_existing_creation_timestamp(self):
+        app = AppRecord(TEST_APP_DATA)
+        res = upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        self.assertTrue(res["created"])
+        app = AppRecord(TEST_APP_DATA)
+        app["installedAt"] = 42
+        app["name"] = "Changed"
+        res = upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        self.assertFalse(res["created"])
+        self.assertEquals(app["installedAt"], TEST_APP_DATA["installedAt"])
+        stored = self._get_stored_item("apps", app.get_id())
+        self.assertEquals(stored["installedAt"], TEST_APP_DATA["installedAt"])
+
+        device = DeviceRecord(TEST_DEVICE_DATA)
+        upsert_record(self.storage, 1, "devices", device.get_id(), device)
+        device = DeviceRecord(TEST_DEVICE_DATA)
+        device["addedAt"] = 42
+        device["name"] = "Changed"
+        upsert_record(self.storage, 1, "devices", device.get_id(), device)
+        stored = self._get_stored_item("devices", device.get_id())
+        self.assertEquals(stored["addedAt"], TEST_DEVICE_DATA["addedAt"])
+
+    def test_that_writes_are_refused_once_over_quota(self):
+        app = AppRecord(TEST_APP_DATA)
+        upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        old_quota_size = getattr(self.storage, "quota_size", None)
+        self.storage.quota_size = self.storage.get_total_size(1)
+        try:
+            app = AppRecord(TEST_APP_DATA)
+            app["origin"] = "https://example2.com"
+            self.assertRaises(OverQuotaError, upsert_record, self.storage,
+                              1, "apps", app.get_id(), app)
+            self.assertRaises(OverQuotaError, upsert_records, self.storage,
+                              1, "apps", [app])
+            self.assertRaises(NotFoundError, self.storage.get_item, 1,
+                              "apps", app.get_id())
+            # Other users are unaffected.
+            upsert_record(self.storage, 2, "apps", app.get_id(), app)
+        finally:
+            self.storage.quota_size = old_quota_size
+
+    def test_that_writes_need_a_backend_that_can_lock(self):
+        storage = UnlockableStorage(self.storage)
+        app = AppRecord(TEST_APP_DATA)
+        self.assertRaises(LockNotSupportedError, upsert_record, storage,
+                          1, "apps", app.get_id(), app)
+        self.assertRaises(LockNotSupportedError, upsert_records, storage,
+                          1, "apps", [app])
+        self.assertRaises(NotFoundError, self.storage.get_item, 1,
+                          "apps", app.get_id())
+        upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        self.assertRaises(LockNotSupportedError, delete_record, storage,
+                          1, "apps", app.get_id(), AppRecord, 42)
+        self.assertFalse(is_tombstone(self.storage.get_item(
+            1, "apps", app.get_id())["payload"]))
+
+    def test_that_upsert_preconditions_can_abort_the_write(self):
+        seen = []
+
+        def precondition(old_bso):
+            seen.append(old_bso)
+            if old_bso is not None:
+                raise RuntimeError("already exists")
+
+        app = AppRecord(TEST_APP_DATA)
+        upsert_record(self.storage, 1, "apps", app.get_id(), app,
+                      precondition)
+        self.assertEquals(seen, [None])
+        app = AppRecord(TEST_APP_DATA)
+        app["name"] = "Changed"
+        self.assertRaises(RuntimeError, upsert_record, self.storage, 1,
+                          "apps", app.get_id(), app, precondition)
+        stored = self._get_stored_item("apps", app.get_id())
+        self.assertEquals(stored["name"], TEST_APP_DATA["name"])
+
+    def test_iterating_through_pages_of_items(self):
+        app = AppRecord(TEST_APP_DATA)
+        for i in xrange(5):
+            app["origin"] = "https://example%d.com" % (i,)
+            upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        pages = list(iter_item_pages(self.storage, 1, "apps", page_size=2))
+        self.assertEquals([len(page) for page in pages], [2, 2, 1])
+        ids = set(bso["id"] for page in pages for bso in page)
+        self.assertEquals(len(ids), 5)
+
+    def test_that_pages_resume_from_the_last_item(self):
+        # Items written in the same batch share a timestamp, so pages have
+        # to be able to end part-way through them.
+        apps = []
+        for i in xrange(5):
+            app = AppRecord(TEST_APP_DATA)
+            app["origin"] = "https://example%d.com" % (i,)
+            apps.append(app)
+        upsert_records(self.storage, 1, "apps", apps)
+        bsos, more = get_item_page(self.storage, 1, "apps", 2)
+        self.assertTrue(more)
+        seen = [bso["id"] for bso in bsos]
+        # Rewriting an item that was already listed moves it to the end,
+        # without making any of the others get skipped.
+        time.sleep(0.01)
+        app = [app for app in apps if app.get_id() == seen[0]][0]
+        app["name"] = "Changed"
+        upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        while more:
+            last = bsos[-1]
+            bsos, more = get_item_page(self.storage, 1, "apps", 2,
+                                       last["modified"], last["id"])
+            self.assertTrue(len(bsos) <= 2)
+            seen.extend(bso["id"] for bso in bsos)
+        self.assertEquals(sorted(set(seen)),
+                          sorted(app.get_id() for app in apps))
+        self.assertEquals(len(seen), 6)
+
+    def test_that_batch_upsert_keeps_existing_creation_timestamps(self):
+        app = AppRecord(TEST_APP_DATA)
+        upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        apps = []
+        for i in xrange(3):
+            app = AppRecord(TEST_APP_DATA)
+            app["installedAt"] = 42
+            if i:
+                app["origin"] = "https://example%d.com" % (i,)
+            apps.append(app)
+        upsert_records(self.storage, 1, "apps", apps)
+        installed = [self._get_stored_item("apps", app.get_id())["installedAt"]
+                     for app in apps]
+        self.assertEquals(installed, [TEST_APP_DATA["installedAt"], 42, 42])
+
+    def test_that_unchanged_records_are_not_rewritten(self):
+        app = AppRecord(TEST_APP_DATA)
+        res1 = upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        app = AppRecord(TEST_APP_DATA)
+        app["modifiedAt"] = 42
+        res2 = upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        self.assertTrue(res2["unchanged"])
+        self.assertEquals(res2["modified"], res1["modified"])
+        stored = self._get_stored_item("apps", app.get_id())
+        self.assertEquals(stored["modifiedAt"], TEST_APP_DATA["modifiedAt"])
+        # Batch writes skip them too.
+        ts = upsert_records(self.storage, 1, "apps", [app])
+        self.assertEquals(ts, res1["modified"])
+        # But any change to the content gets written.
+        app["name"] = "Changed"
+        res3 = upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        self.assertFalse(res3.get("unchanged"))
+        self.assertTrue(res3["modified"] > res1["modified"])
+        stored = self._get_stored_item("apps", app.get_id())
+        self.assertEquals(stored["name"], "Changed")
+
+    def test_that_delete_preconditions_can_abort_the_delete(self):
+        app = AppRecord(TEST_APP_DATA)
+        upsert_record(self.storage, 1, "apps", app.get_id(), app)
+
+        def precondition(old_bso):
+            raise RuntimeError("not allowed")
+
+        self.assertRaises(RuntimeError, delete_record, self.storage, 1,
+                          "apps", app.get_id(), AppRecord, 42, precondition)
+        self._get_stored_item("apps", app.get_id())
+        delete_record(self.storage, 1, "apps", app.get_id(), AppRecord, 42)
+        self.assertRaises(NotFoundError, delete_record, self.storage, 1,
+                          "apps", app.get_id(), AppRecord, 42)
+
+    def test_that_deleted_records_leave_tombstones(self):
+        app = AppRecord(TEST_APP_DATA)
+        upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        ts = delete_record(self.storage, 1, "apps", app.get_id(),
+                           AppRecord, 42)
+        bso = self.storage.get_item(1, "apps", app.get_id())
+        self.assertTrue(is_tombstone(bso["payload"]))
+        self.assertEquals(bso["modified"], ts)
+        self.assertEquals(self._get_stored_item("apps", app.get_id()), {
+            "origin": TEST_APP_DATA["origin"],
+            "deleted": True,
+            "deletedAt": 42,
+            "modifiedAt": 42,
+        })
+        # Writing the record again brings it back to life.
+        app = AppRecord(TEST_APP_DATA)
+        app["installedAt"] = 43
+        res = upsert_record(self.storage, 1, "apps", app.get_id(), app)
+        self.assertTrue(res["created"])
+        stored = self._get_stored_item("apps", app.get_id())
+        self.assertEquals(stored["installedAt"], 43)
+
+    def test_deleting_several_records_at_once(self):
+        device = DeviceRecord(TEST_DEVICE_DATA)
+        upsert_record(self.storage, 1, "devices", device.get_id(), device)
+        ts = delete_records(self.storage, 1, "devices", DeviceRecord, 42,
+                            [device.get_id(), "NONEXISTENT"])
+        self.assertTrue(ts is not None)
+        stored = self._get_stored_item("devices", device.get_id())
+        self.assertEquals(stored["uuid"], TEST_DEVICE_DATA["uuid"])
+        self.assertTrue(stored["deleted"])
+        # Deleting them again does nothing.
+        self.assertEquals(delete_records(self.storage, 1, "devices",
+                                         DeviceRecord, 42), None)
+
+    def test_purging_of_old_tombstones(self):
+        apps = []
+        for i in xrange(3):
+            app = AppRecord(TEST_APP_DATA)
+            app["origin"] = "https://example%d.com" % (i,)
+            upsert_record(self.storage, 1, "apps", app.get_id(), app)
+            apps.append(app)
+        ts1 = delete_record(self.storage, 1, "apps", apps[0].get_id(),
+                            AppRecord, 42)
+        time.sleep(0.01)
+        ts2 = delete_record(self.storage, 1, "apps", apps[1].get_id(),
+                            AppRecord, 42)
+        self.assertEquals(purge_tombstones(self.storage, 1, "apps", ts1), 0)
+        self.assertEquals(purge_tombstones(self.storage, 1, "apps", ts2), 1)
+        self.assertRaises(NotFoundError, self.storage.get_item, 1, "apps",
+                          apps[0].get_id())
+        # Only tombstones are purged, never live items.
+        self.assertEquals(purge_tombstones(self.storage, 1, "apps",
+                                           ts2 + 1000), 1)
+        self._get_stored_item("apps", apps[2].get_id())
+
+    def test_that_listings_by_timestamp_are_backed_by_an_index(self):
+        # Only SQL backends have any indexes to check.
+        backend = getattr(self.storage, "storage", self.storage)
+        dbconnector = getattr(backend, "dbconnector", None)
+        if dbconnector is None:
+            return
+        # The tests run with create_tables, so the index exists already.
+        self.assertEquals(find_missing_indexes(self.storage), [])
+        self.assertEquals(create_missing_indexes(self.storage), [])
+        # Drop it, and check that it gets put back.
+        from sqlalchemy import MetaData
+        metadata = MetaData()
+        metadata.reflect(bind=dbconnector.engine)
+        dropped = []
+        for table in metadata.tables.itervalues():
+            for index in list(table.indexes):
+                columns = tuple(column.name for column in index.columns)
+                if columns[:3] == MODIFIED_INDEX_COLUMNS:
+                    index.drop(bind=dbconnector.engine)
+                    dropped.append(table.name)
+        self.assertTrue(dropped)
+        missing = [table.name for table in find_missing_indexes(self.storage)]
+        self.assertEquals(sorted(missing), sorted(dropped))
+        created = create_missing_indexes(self.storage)
+        self.assertEquals(sorted(created), sorted(dropped))
+        self.assertEquals(find_missing_indexes(self.storage), [])
+
+    def test_iterating_over_userids_with_data(self):
+        for userid in (3, 7, 9):
+            app = AppRecord(TEST_APP_DATA)
+            upsert_record(self.storage, userid, "apps", app.get_id(), app)
+        throttles = []
+        userids = list(iter_userids(self.storage, 2, 8, batch_size=1,
+                                    throttle=lambda: throttles.append(1)))
+        backend = getattr(self.storage, "storage", self.storage)
+        if getattr(backend, "dbconnector", None) is None:
+            # Other backends can't skip the userids without data.
+            self.assertEquals(userids, range(2, 9))
+        else:
+            self.assertEquals(userids, [3, 7])
+            # One query per batch, and one more to find there are no more.
+            self.assertEquals(len(throttles), 3)
+
+    def test_keeping_count_of_tombstones(self):
+        self.assertEquals(get_tombstone_stats(self.storage, 1), {})
+        apps = []
+        for i in xrange(3):
+            app = AppRecord(TEST_APP_DATA)
+            app["origin"] = "https://example%d.com" % (i,)
+            apps.append(app)
+        upsert_records(self.storage, 1, "apps", apps)
+        delete_record(self.storage, 1, "apps", apps[0].get_id(),
+                      AppRecord, 42)
+        stats = get_tombstone_stats(self.storage, 1)
+        self.assertEquals(stats.keys(), ["apps"])
+        self.assertEquals(stats["apps"]["count"], 1)
+        size = stats["apps"]["bytes"]
+        self.assertTrue(size > 0)
+        delete_records(self.storage, 1, "apps", AppRecord, 42)
+        stats = get_tombstone_stats(self.storage, 1)
+        self.assertEquals(stats["apps"]["count"], 3)
+        # Re-creating an item or purging its tombstone takes it off.
+        upsert_record(self.storage, 1, "apps", apps[0].get_id(), apps[0])
+        upsert_records(self.storage, 1, "apps", apps[1:2])
+        stats = get_tombstone_stats(self.storage, 1)
+        self.assertEquals(stats["apps"]["count"], 1)
+        ts = self.storage.get_collection_timestamp(1, "apps")
+        self.assertEquals(purge_tombstones(self.storage, 1, "apps", ts + 1),
+                          1)
+        self.assertEquals(get_tombstone_stats(self.storage, 1), {})
+
+    def test_backfilling_legacy_payloads(self):
+        # Only SQL backends can be rewritten without changing timestamps.
+        backend = getattr(self.storage, "storage", self.storage)
+        if getattr(backend, "dbconnector", None) is None:
+            return
+        app = AppRecord(TEST_APP_DATA)
+        legacy = json.dumps(app.to_dict())
+        self.storage.set_item(1, "apps", app.get_id(), {"payload": legacy})
+        # An item in another collection with the same id and payload must
+        # be left alone.
+        self.storage.set_item(1, "devices", app.get_id(),
+                              {"payload": legacy})
+        old_bso = self.storage.get_item(1, "apps", app.get_id())
+        self.assertEquals(split_payload(old_bso["payload"])[1], None)
+        self.assertEquals(backfill_payloads(self.storage, 1, "apps",
+                                            AppRecord), 1)
+        bso = self.storage.get_item(1, "apps", app.get_id())
+        self.assertEquals(bso["modified"], old_bso["modified"])
+        full, abbrev = split_payload(bso["payload"])
+        self.assertEquals(full, legacy)
+        self.assertEquals(json.loads(abbrev), app.abbreviate())
+        self.assertEquals(get_payload_hash(bso["payload"]),
+                          app.content_hash())
+        other = self.storage.get_item(1, "devices", app.get_id())
+        self.assertEquals(other["payload"], legacy)
+        # There's nothing left to do the second time around.
+        self.assertEquals(backfill_payloads(self.storage, 1, "apps",
+                                            AppRecord), 0)
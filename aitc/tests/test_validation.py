@@ -182,3 +182,73 @@ class TestRecordHandling(unittest.TestCase):
         ok, error = app2.validate()
         self.assertTrue(ok)
         self.assertEquals(app1.get_id(), app2.get_id())
+
+    def test_that_records_round_trip_to_the_same_dict(self):
+        data = {
+            "uuid": "75B538D8-67AF-44E8-86A0-B1A07BE137C8",
+            "name": "Anant's Mac Pro",
+            "type": "mobile",
+            "layout": "android/phone",
+            "addedAt": 1330535996745,
+            "modifiedAt": 1330535996945,
+            "apps": {"foo": "bar"},
+        }
+        device = DeviceRecord(data)
+        self.assertEquals(device.to_dict(), data)
+        self.assertEquals(device, data)
+        abbrev = data.copy()
+        del abbrev["apps"]
+        self.assertEquals(device.abbreviate(), abbrev)
+        # Fields set to None are treated as missing.
+        device = DeviceRecord(dict(data, apps=None))
+        self.assertFalse("apps" in device)
+        self.assertEquals(device.get("apps"), None)
+        self.assertRaises(KeyError, device.__getitem__, "apps")
+        # Ignored unknown fields are still carried through.
+        device = DeviceRecord(dict(data, extra="field"),
+                              ignore_unknown_fields=True)
+        self.assertEquals(device.to_dict(), dict(data, extra="field"))
+        self.assertEquals(device["extra"], "field")
+
+    def test_validation_error_messages(self):
+        app_data = {
+            "origin": "https://example.com",
+            "manifestPath": "/manifest.webapp",
+            "installOrigin": "https://marketplace.mozilla.org",
+            "installedAt": 1330535996745,
+            "modifiedAt": 1330535996945,
+            "name": "Examplinator 3000",
+            "receipts": ["receipt1", "receipt2"],
+        }
+        device_data = {
+            "uuid": "75B538D8-67AF-44E8-86A0-B1A07BE137C8",
+            "name": "Anant's Mac Pro",
+            "type": "mobile",
+            "layout": "android/phone",
+            "addedAt": 1330535996745,
+            "modifiedAt": 1330535996945,
+            "apps": {},
+        }
+        self.assertEquals(AppRecord().validate(),
+                          (False, "missing field 'origin'"))
+        self.assertEquals(DeviceRecord().validate(),
+                          (False, "missing field 'name'"))
+        for RecordClass, good_data, field, value, error in (
+            (AppRecord, app_data, "name", 42, "name must be a string"),
+            (AppRecord, app_data, "modifiedAt", "1",
+             "modifiedAt must be an integer"),
+            (AppRecord, app_data, "receipts", "x", "receipts must be a list"),
+            (AppRecord, app_data, "receipts", [1],
+             "receipts must be a list of strings"),
+            (AppRecord, app_data, "hidden", False,
+             "hidden must be boolean true"),
+            (DeviceRecord, device_data, "layout", "",
+             "layout must be non-empty"),
+            (DeviceRecord, device_data, "uuid", 42,
+             "uuid must be a valid UUID"),
+            (DeviceRecord, device_data, "apps", [], "apps must be a dict"),
+        ):
+            bad_data = good_data.copy()
+            bad_data[field] = value
+            self.assertEquals(RecordClass(bad_data).validate(),
+                              (False, error))
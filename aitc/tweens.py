@@ -2,11 +2,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import zlib
 import traceback
 
 from pyramid.httpexceptions import WSGIHTTPException
 
 
+# Added to the ETag of a response when it's compressed, since the gzipped
+# body differs from the identity one byte for byte.
+GZIP_ETAG_SUFFIX = "-gzip"
+
+
 def log_all_errors(handler, registry):
     """Tween to log all errors via metlog."""
 
@@ -24,5 +30,76 @@ def log_all_errors(handler, registry):
     return log_all_errors_tween
 
 
+def compress_responses(handler, registry):
+    """Tween to gzip JSON responses for clients that accept it.
+
+    This is off unless the "aitc.gzip_responses" setting is true.  Bodies
+    shorter than "aitc.gzip_min_size" bytes are sent as-is, since there's
+    little to gain from compressing them.  Streamed bodies are of unknown
+    size and are always compressed.
+
+    Compressed responses have GZIP_ETAG_SUFFIX added to their ETag, and
+    all responses that might have been compressed, including 304s for
+    them, are marked as varying by Accept-Encoding.
+    """
+    settings = registry.settings
+    if not settings.get("aitc.gzip_responses", False):
+        return handler
+    min_size = int(settings.get("aitc.gzip_min_size", 1024))
+    level = int(settings.get("aitc.gzip_level", 6))
+
+    def compress_responses_tween(request):
+        response = handler(request)
+        if response.status_int == 304:
+            add_vary(response, "Accept-Encoding")
+            return response
+        if response.status_int != 200:
+            return response
+        if response.content_type != "application/json":
+            return response
+        if response.content_encoding is not None:
+            return response
+        add_vary(response, "Accept-Encoding")
+        if "Accept-Encoding" not in request.headers:
+            return response
+        if not request.accept_encoding.quality("gzip"):
+            return response
+        if response.content_length is not None:
+            if response.content_length < min_size:
+                return response
+        response.app_iter = gzip_app_iter(response.app_iter, level)
+        response.content_length = None
+        response.content_encoding = "gzip"
+        etag = response.headers.get("ETag")
+        if etag is not None and etag.endswith('"'):
+            response.headers["ETag"] = etag[:-1] + GZIP_ETAG_SUFFIX + '"'
+        return response
+
+    return compress_responses_tween
+
+
+def add_vary(response, header):
+    """Add a header to a response's Vary list, unless it's there already."""
+    vary = tuple(response.vary or ())
+    if header not in vary:
+        response.vary = vary + (header,)
+
+
+def gzip_app_iter(app_iter, level=6):
+    """Generate the gzip-compressed output of the given app_iter."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in app_iter:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(app_iter, "close", None)
+        if close is not None:
+            close()
+
+
 def includeme(config):
     config.add_tween("aitc.tweens.log_all_errors")
+    config.add_tween("aitc.tweens.compress_responses")
@@ -37,6 +37,7 @@ class AITCService(MetricsService):
 
 
 root = AITCService(name="root", path="/")
+info = AITCService(name="info", path="/info")
 collection = AITCService(name="collection", path="/{collection}/")
 item = AITCService(name="item", path="/{collection}/{item}")
 
@@ -45,12 +46,37 @@ def _ctrl(request):
     return request.registry["aitc.controller"]
 
 
-@collection.get(renderer="simplejson")
+@root.get(renderer="aitc.json")
+def get_root(request):
+    return _ctrl(request).get_collections(request)
+
+
+@root.delete()
+def delete_root(request):
+    return _ctrl(request).delete_storage(request)
+
+
+@info.get(renderer="aitc.json")
+def get_info(request):
+    return _ctrl(request).get_info(request)
+
+
+@collection.get(renderer="aitc.json")
 def get_collection(request):
     return _ctrl(request).get_collection(request)
 
 
-@item.get(renderer="simplejson")
+@collection.post(renderer="aitc.json")
+def post_collection(request):
+    return _ctrl(request).set_items(request)
+
+
+@collection.delete()
+def delete_collection(request):
+    return _ctrl(request).delete_collection(request)
+
+
+@item.get(renderer="aitc.json")
 def get_item(request):
     return _ctrl(request).get_item(request)
 
@@ -7,7 +7,7 @@ import re
 
 
 install_requires = ['SQLALchemy', 'unittest2', 'mozsvc', 'cornice',
-                    'metlog-py']
+                    'metlog-py', 'repoze.lru']
 
 entry_points = """
 [paste.app_factory]
@@ -15,6 +15,9 @@ main = aitc:main
 
 [paste.app_install]
 main = paste.script.appinstall:Installer
+
+[console_scripts]
+aitc-purge = aitc.purge:main
 """
 
 # extracting the version number from the .spec file